@@ -1,5 +1,7 @@
 from .tree_generation import *
 from .probing import *
 from .utils import *
+from .loggers import *
+from .fast_transformer import *
 from .interp_utils import *
 from .attention_knockout import *
@@ -0,0 +1,163 @@
+import argparse
+import time
+
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from .fast_transformer import FastTransformer
+from .tree_generation.dataset import GraphTokenizer, generate_dataset_line
+from .utils import configure_cpu_threads, get_autocast, get_device, get_train_step, is_model_correct_multiple
+
+
+def get_training_config(n_states=16, device="cpu"):
+    # Model trained by training.py
+    tokenizer = GraphTokenizer(n_states)
+    return HookedTransformerConfig(
+        n_layers=6,
+        d_model=128,
+        n_ctx=tokenizer.max_seq_length - 1,
+        n_heads=1,
+        d_mlp=512,
+        d_head=128,
+        d_vocab=len(tokenizer.idx2tokens),
+        device=device,
+        attention_dir="causal",
+        act_fn="gelu",
+    )
+
+
+def benchmark_train_step(cfg, model_cls=HookedTransformer, compile_step=False, n_states=16, batch_size=64,
+                         n_steps=50, n_warmup=5, precision="fp32"):
+    """Measure training steps per second on generated examples.
+
+    Args:
+        cfg (HookedTransformerConfig): Model config
+        model_cls (type, optional): HookedTransformer or FastTransformer. Defaults to HookedTransformer.
+        compile_step (bool, optional): Compile the step, see get_train_step. Defaults to False.
+        n_states (int, optional): Number of nodes of the example trees. Defaults to 16.
+        batch_size (int, optional): Batch size. Defaults to 64.
+        n_steps (int, optional): Timed steps. Defaults to 50.
+        n_warmup (int, optional): Untimed steps before, including compilation. Defaults to 5.
+        precision (str, optional): "fp32" or "bf16", see get_autocast. Defaults to "fp32".
+
+    Returns:
+        float: Steps per second
+    """
+    tokenizer = GraphTokenizer(n_states)
+    n_batches = 4
+    lines = [generate_dataset_line(n_states, seed) for seed in range(n_batches * batch_size)]
+    X = tokenizer.tokenize_batch(lines)
+    tokens = torch.from_numpy(X).to(cfg.device).split(batch_size)
+    masks = torch.from_numpy(tokenizer.create_masks(X)).to(cfg.device).split(batch_size)
+
+    model = model_cls(cfg)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), 3e-4, betas=(0.9, 0.99), weight_decay=0.01)
+    step = get_train_step(model, optimizer, torch.nn.CrossEntropyLoss(), compile_step=compile_step,
+                          precision=precision)
+    for i in range(n_warmup):
+        step(tokens[i % n_batches], masks[i % n_batches])
+    start = time.perf_counter()
+    for i in range(n_steps):
+        loss, _ = step(tokens[i % n_batches], masks[i % n_batches])
+    # Wait for queued kernels on GPUs
+    loss.item()
+    return n_steps / (time.perf_counter() - start)
+
+
+def get_path_correct(tokenizer, tokens, predictions):
+    # Per example version of is_model_correct: every prediction from the start token up to
+    # the last non-padding token has to match
+    length = tokens.shape[1]
+    start = (tokens == tokenizer.start_token).int().argmax(dim=1) + 1
+    end = length - (tokens != tokenizer.pad_token).flip(1).int().argmax(dim=1)
+    positions = torch.arange(length - 1)
+    valid = (positions >= start[:, None]) & (positions < end.clamp(max=length - 1)[:, None])
+    matches = predictions == tokens[:, 1:]
+    return (matches | ~valid).all(dim=1), matches, valid
+
+
+def precision_report(model_path="model.pt", precisions=("fp32", "bf16"), n_examples=2048, batch_size=256,
+                     n_states=16, device="cpu", seed=1_000_000):
+    """Evaluate a trained HookedTransformer checkpoint in several precisions and compare
+    every precision's predictions and logits with fp32.
+
+    Args:
+        model_path (str, optional): State dict of the training.py model. Defaults to "model.pt".
+        precisions (Iterable[str], optional): Precisions to evaluate. Defaults to ("fp32", "bf16").
+        n_examples (int, optional): Number of generated examples. Defaults to 2048.
+        batch_size (int, optional): Batch size of the forward passes. Defaults to 256.
+        n_states (int, optional): Number of nodes of the example trees. Defaults to 16.
+        device (str, optional): Device. Defaults to "cpu".
+        seed (int, optional): First seed of the examples. Defaults to 1_000_000.
+
+    Returns:
+        Dict[str, Dict[str, float]]: Per precision the exact path accuracy, the accuracy on path
+            tokens, the agreement of predicted path tokens with fp32, the max. absolute logit
+            difference to fp32, whether is_model_correct_multiple still holds on a batch of
+            examples solved in fp32, and the examples per second
+    """
+    tokenizer = GraphTokenizer(n_states)
+    lines = [generate_dataset_line(n_states, s) for s in range(seed, seed + n_examples)]
+    tokens = torch.from_numpy(tokenizer.tokenize_batch(lines))
+    model = HookedTransformer(get_training_config(n_states, device))
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+
+    report, reference = {}, None
+    for precision in precisions:
+        logits = []
+        start = time.perf_counter()
+        with torch.no_grad(), get_autocast(device, precision):
+            for batch in tokens.split(batch_size):
+                logits.append(model(batch[:, :-1].to(device)).float().cpu())
+        elapsed = time.perf_counter() - start
+        logits = torch.cat(logits)
+        predictions = logits.argmax(-1)
+        correct, matches, valid = get_path_correct(tokenizer, tokens, predictions)
+        if reference is None:
+            reference = logits
+            solved = [line for line, is_correct in zip(lines, correct) if is_correct][:batch_size]
+        report[precision] = {
+            "path_accuracy": correct.float().mean().item(),
+            "token_accuracy": matches[valid].float().mean().item(),
+            "agreement_with_fp32": (predictions == reference.argmax(-1))[valid].float().mean().item(),
+            "max_abs_logit_diff": (logits - reference).abs().max().item(),
+            "is_model_correct_multiple": is_model_correct_multiple(model, tokenizer, solved, precision=precision),
+            "examples_per_second": n_examples / elapsed,
+        }
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Training steps per second, eager vs. compiled or fp32 vs. bf16")
+    parser.add_argument('--device', default="cpu")
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--n_steps', type=int, default=50)
+    parser.add_argument('--precision_report', action='store_true', help="compare bf16 and fp32 instead")
+    parser.add_argument('--model_path', default="model.pt")
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    if device.type == "cpu":
+        configure_cpu_threads()
+    cfg = get_training_config(device=str(device))
+    print(f"{torch.get_num_threads()} threads, CPU capability {torch.backends.cpu.get_cpu_capability()}, "
+          f"batch size {args.batch_size}")
+    if args.precision_report:
+        # Accuracy of the trained model and training speed per precision
+        for precision, results in precision_report(args.model_path, device=str(device)).items():
+            print(precision, {key: round(value, 6) if isinstance(value, float) else value
+                              for key, value in results.items()})
+        for precision in ["fp32", "bf16"]:
+            steps_per_second = benchmark_train_step(cfg, FastTransformer, batch_size=args.batch_size,
+                                                    n_steps=args.n_steps, precision=precision)
+            print(f"FastTransformer training, {precision}: {steps_per_second:.2f} steps/s")
+    else:
+        for model_cls in [HookedTransformer, FastTransformer]:
+            eager = benchmark_train_step(cfg, model_cls, batch_size=args.batch_size, n_steps=args.n_steps)
+            compiled = benchmark_train_step(cfg, model_cls, compile_step=True, batch_size=args.batch_size,
+                                            n_steps=args.n_steps)
+            print(f"{model_cls.__name__:>18}: eager {eager:.2f} steps/s, compiled {compiled:.2f} steps/s "
+                  f"({compiled / eager:.2f}x)")
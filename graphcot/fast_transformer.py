@@ -0,0 +1,302 @@
+import copy
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+ACTIVATIONS = {
+    "gelu": F.gelu,
+    "gelu_new": lambda x: F.gelu(x, approximate="tanh"),
+    "relu": F.relu,
+    "silu": F.silu,
+}
+
+
+def check_fast_config(cfg):
+    # Only the architecture HookedTransformer builds for our configs is implemented. Fields
+    # missing from older transformer_lens releases, such as the pinned 1.10, get their defaults.
+    unsupported = {
+        "normalization_type": cfg.normalization_type != "LN",
+        "positional_embedding_type": cfg.positional_embedding_type != "standard",
+        "attention_dir": cfg.attention_dir != "causal",
+        "act_fn": cfg.act_fn not in ACTIVATIONS,
+        "gated_mlp": getattr(cfg, "gated_mlp", False),
+        "parallel_attn_mlp": getattr(cfg, "parallel_attn_mlp", False),
+        "n_key_value_heads": getattr(cfg, "n_key_value_heads", None) is not None,
+        "use_local_attn": getattr(cfg, "use_local_attn", False),
+        "final_rms": getattr(cfg, "final_rms", False),
+        "attn_scores_soft_cap": getattr(cfg, "attn_scores_soft_cap", -1.0) > 0,
+        "output_logits_soft_cap": getattr(cfg, "output_logits_soft_cap", -1.0) > 0,
+    }
+    for field, is_unsupported in unsupported.items():
+        if is_unsupported:
+            raise ValueError(f"FastTransformer does not support {field}={getattr(cfg, field)}")
+
+
+class FastLayerNorm(nn.Module):
+
+    def __init__(self, cfg):
+        super().__init__()
+        self.eps = cfg.eps
+        self.w = nn.Parameter(torch.ones(cfg.d_model, dtype=cfg.dtype))
+        self.b = nn.Parameter(torch.zeros(cfg.d_model, dtype=cfg.dtype))
+
+    def forward(self, x):
+        return F.layer_norm(x, self.w.shape, self.w, self.b, self.eps)
+
+
+class FastAttention(nn.Module):
+
+    def __init__(self, cfg):
+        super().__init__()
+        self.cfg = cfg
+        # Registered in HookedTransformer's order
+        self.W_Q = nn.Parameter(torch.empty(cfg.n_heads, cfg.d_model, cfg.d_head, dtype=cfg.dtype))
+        self.W_O = nn.Parameter(torch.empty(cfg.n_heads, cfg.d_head, cfg.d_model, dtype=cfg.dtype))
+        self.b_Q = nn.Parameter(torch.zeros(cfg.n_heads, cfg.d_head, dtype=cfg.dtype))
+        self.b_O = nn.Parameter(torch.zeros(cfg.d_model, dtype=cfg.dtype))
+        self.W_K = nn.Parameter(torch.empty(cfg.n_heads, cfg.d_model, cfg.d_head, dtype=cfg.dtype))
+        self.W_V = nn.Parameter(torch.empty(cfg.n_heads, cfg.d_model, cfg.d_head, dtype=cfg.dtype))
+        self.b_K = nn.Parameter(torch.zeros(cfg.n_heads, cfg.d_head, dtype=cfg.dtype))
+        self.b_V = nn.Parameter(torch.zeros(cfg.n_heads, cfg.d_head, dtype=cfg.dtype))
+        # Unused here, kept so the state dict matches HookedTransformer's
+        self.register_buffer("mask", torch.tril(torch.ones((cfg.n_ctx, cfg.n_ctx)).bool()))
+        self.register_buffer("IGNORE", torch.tensor(-torch.inf))
+        self.scale = 1 / cfg.attn_scale if cfg.use_attn_scale else 1.0
+
+    def forward(self, x):
+        batch, pos, _ = x.shape
+        n_heads, d_head = self.cfg.n_heads, self.cfg.d_head
+        # One matmul for queries, keys and values of all heads: [d_model, 3 * n_heads * d_head]
+        W_QKV = torch.cat([self.W_Q, self.W_K, self.W_V], dim=0).permute(1, 0, 2).flatten(1)
+        b_QKV = torch.cat([self.b_Q, self.b_K, self.b_V], dim=0).flatten()
+        qkv = (x @ W_QKV + b_QKV).view(batch, pos, 3 * n_heads, d_head).transpose(1, 2)
+        q, k, v = qkv.split(n_heads, dim=1)
+        z = F.scaled_dot_product_attention(q, k, v, is_causal=True, scale=self.scale)
+        z = z.transpose(1, 2).reshape(batch, pos, n_heads * d_head)
+        return z @ self.W_O.flatten(0, 1) + self.b_O
+
+
+class FastMLP(nn.Module):
+
+    def __init__(self, cfg):
+        super().__init__()
+        self.W_in = nn.Parameter(torch.empty(cfg.d_model, cfg.d_mlp, dtype=cfg.dtype))
+        self.b_in = nn.Parameter(torch.zeros(cfg.d_mlp, dtype=cfg.dtype))
+        self.W_out = nn.Parameter(torch.empty(cfg.d_mlp, cfg.d_model, dtype=cfg.dtype))
+        self.b_out = nn.Parameter(torch.zeros(cfg.d_model, dtype=cfg.dtype))
+        self.act_fn = ACTIVATIONS[cfg.act_fn]
+
+    def forward(self, x):
+        return self.act_fn(x @ self.W_in + self.b_in) @ self.W_out + self.b_out
+
+
+class FastBlock(nn.Module):
+
+    def __init__(self, cfg):
+        super().__init__()
+        self.attn_only = cfg.attn_only
+        # Registered in HookedTransformer's order, so seeded inits draw the same weights
+        self.ln1 = FastLayerNorm(cfg)
+        if not cfg.attn_only:
+            self.ln2 = FastLayerNorm(cfg)
+        self.attn = FastAttention(cfg)
+        if not cfg.attn_only:
+            self.mlp = FastMLP(cfg)
+
+    def forward(self, x):
+        x = x + self.attn(self.ln1(x))
+        if not self.attn_only:
+            x = x + self.mlp(self.ln2(x))
+        return x
+
+
+class FastTransformer(nn.Module):
+    """Training-only counterpart of HookedTransformer without hook points or activation
+    caching, using fused scaled dot product attention. Parameters and buffers carry the
+    same names and shapes as in HookedTransformer, so state dicts load in both directions.
+    """
+
+    def __init__(self, cfg):
+        super().__init__()
+        if isinstance(cfg, dict):
+            cfg = HookedTransformerConfig(**cfg)
+        check_fast_config(cfg)
+        self.cfg = cfg
+        self.embed = nn.Module()
+        self.embed.W_E = nn.Parameter(torch.empty(cfg.d_vocab, cfg.d_model, dtype=cfg.dtype))
+        self.pos_embed = nn.Module()
+        self.pos_embed.W_pos = nn.Parameter(torch.empty(cfg.n_ctx, cfg.d_model, dtype=cfg.dtype))
+        self.blocks = nn.ModuleList([FastBlock(cfg) for _ in range(cfg.n_layers)])
+        self.ln_final = FastLayerNorm(cfg)
+        self.unembed = nn.Module()
+        self.unembed.W_U = nn.Parameter(torch.empty(cfg.d_model, cfg.d_vocab_out, dtype=cfg.dtype))
+        self.unembed.b_U = nn.Parameter(torch.zeros(cfg.d_vocab_out, dtype=cfg.dtype))
+        self.init_weights()
+        if cfg.device is not None:
+            self.to(cfg.device)
+
+    def init_weights(self):
+        # Same scheme as HookedTransformer's default "gpt2" init
+        if self.cfg.seed is not None:
+            torch.manual_seed(self.cfg.seed)
+        for name, param in self.named_parameters():
+            if "W_" in name:
+                nn.init.normal_(param, std=self.cfg.initializer_range)
+
+    def forward(self, tokens):
+        x = self.embed.W_E[tokens] + self.pos_embed.W_pos[:tokens.shape[-1]]
+        for block in self.blocks:
+            x = block(x)
+        return self.ln_final(x) @ self.unembed.W_U + self.unembed.b_U
+
+    @classmethod
+    def from_hooked(cls, model):
+        fast_model = cls(model.cfg)
+        fast_model.load_state_dict(model.state_dict())
+        return fast_model
+
+    def to_hooked(self):
+        model = HookedTransformer(self.cfg)
+        model.load_state_dict(self.state_dict())
+        return model
+
+
+class EnsembleTransformer(nn.Module):
+    """Several FastTransformers with the same config trained side by side. Every parameter
+    gets a leading member dimension and all members run in one batched forward pass over a
+    shared batch, returning logits of shape [n_members, batch, pos, d_vocab_out].
+
+    Members are initialized like a FastTransformer with cfg.seed set to their seed, and
+    member_state_dict() returns a state dict loadable by FastTransformer and HookedTransformer.
+    """
+
+    def __init__(self, cfg, seeds):
+        super().__init__()
+        if isinstance(cfg, dict):
+            cfg = HookedTransformerConfig(**cfg)
+        self.cfg = cfg
+        self.seeds = list(seeds)
+        self.n_members = len(self.seeds)
+        members = []
+        for seed in self.seeds:
+            member_cfg = copy.copy(self.cfg)
+            member_cfg.seed = seed
+            members.append(FastTransformer(member_cfg))
+        # The first member's modules hold the stacks of all members' parameters, so names
+        # and buffers are those of a FastTransformer
+        for module_name in ["embed", "pos_embed", "blocks", "ln_final", "unembed"]:
+            setattr(self, module_name, getattr(members[0], module_name))
+        for name, _ in list(self.named_parameters()):
+            module_name, _, param_name = name.rpartition(".")
+            stacked = torch.stack([member.get_parameter(name).detach() for member in members])
+            setattr(self.get_submodule(module_name), param_name, nn.Parameter(stacked))
+
+    @classmethod
+    def from_hooked(cls, models):
+        # Stack HookedTransformers or FastTransformers with the same config into an ensemble
+        ensemble = cls(models[0].cfg, seeds=[model.cfg.seed for model in models])
+        ensemble.load_member_state_dicts([model.state_dict() for model in models])
+        return ensemble
+
+    def to_hooked(self, member):
+        model = HookedTransformer(self.cfg)
+        model.load_state_dict(self.member_state_dict(member))
+        return model
+
+    def layer_norm(self, x, ln):
+        x = F.layer_norm(x, x.shape[-1:], eps=ln.eps)
+        return x * ln.w.unsqueeze(1) + ln.b.unsqueeze(1)
+
+    def attention(self, x, attn, batch, pos):
+        n_heads, d_head = self.cfg.n_heads, self.cfg.d_head
+        # [n_members, d_model, 3 * n_heads * d_head], see FastAttention
+        W_QKV = torch.cat([attn.W_Q, attn.W_K, attn.W_V], dim=1).permute(0, 2, 1, 3).flatten(2)
+        b_QKV = torch.cat([attn.b_Q, attn.b_K, attn.b_V], dim=1).flatten(1).unsqueeze(1)
+        qkv = torch.baddbmm(b_QKV, x, W_QKV).view(-1, pos, 3 * n_heads, d_head).transpose(1, 2)
+        q, k, v = qkv.split(n_heads, dim=1)
+        # Members and batch share the batch dimension of the fused attention
+        z = F.scaled_dot_product_attention(q, k, v, is_causal=True, scale=attn.scale)
+        z = z.transpose(1, 2).reshape(self.n_members, batch * pos, n_heads * d_head)
+        return torch.baddbmm(attn.b_O.unsqueeze(1), z, attn.W_O.flatten(1, 2))
+
+    def mlp(self, x, mlp):
+        x = mlp.act_fn(torch.baddbmm(mlp.b_in.unsqueeze(1), x, mlp.W_in))
+        return torch.baddbmm(mlp.b_out.unsqueeze(1), x, mlp.W_out)
+
+    def forward(self, tokens):
+        batch, pos = tokens.shape
+        # Activations are kept as [n_members, batch * pos, d_model] so all matmuls are plain bmms
+        x = self.embed.W_E[:, tokens] + self.pos_embed.W_pos[:, None, :pos]
+        x = x.flatten(1, 2)
+        for block in self.blocks:
+            x = x + self.attention(self.layer_norm(x, block.ln1), block.attn, batch, pos)
+            if not block.attn_only:
+                x = x + self.mlp(self.layer_norm(x, block.ln2), block.mlp)
+        logits = torch.baddbmm(self.unembed.b_U.unsqueeze(1), self.layer_norm(x, self.ln_final), self.unembed.W_U)
+        return logits.view(self.n_members, batch, pos, -1)
+
+    def member_state_dict(self, member):
+        # Buffers are shared, parameters are sliced
+        parameter_names = {name for name, _ in self.named_parameters()}
+        return {name: value[member] if name in parameter_names else value
+                for name, value in self.state_dict().items()}
+
+    def load_member_state_dicts(self, state_dicts):
+        parameter_names = {name for name, _ in self.named_parameters()}
+        self.load_state_dict({name: torch.stack([state_dict[name] for state_dict in state_dicts])
+                              if name in parameter_names else value
+                              for name, value in state_dicts[0].items()})
+
+    def member_optimizer_state_dict(self, state_dict, member):
+        """Slice the state dict of an optimizer over this ensemble's parameters. The result
+        loads into the same optimizer over the parameters of a single model."""
+        state = {
+            index: {key: value[member] if torch.is_tensor(value) and value.dim() > 0 else value
+                    for key, value in param_state.items()}
+            for index, param_state in state_dict["state"].items()
+        }
+        return {"state": state, "param_groups": state_dict["param_groups"]}
+
+    def stack_optimizer_state_dicts(self, state_dicts):
+        # Inverse of member_optimizer_state_dict, per-member scalars like Adam's step are taken from the first
+        state = {
+            index: {key: torch.stack([state_dict["state"][index][key] for state_dict in state_dicts])
+                    if torch.is_tensor(value) and value.dim() > 0 else value
+                    for key, value in param_state.items()}
+            for index, param_state in state_dicts[0]["state"].items()
+        }
+        return {"state": state, "param_groups": state_dicts[0]["param_groups"]}
+
+
+def check_hooked_parity(cfg, state_dict, tokens):
+    """Compare the logits of HookedTransformer and FastTransformer on the same weights.
+
+    Args:
+        cfg (HookedTransformerConfig): Model config
+        state_dict (Union[str, dict]): State dict or the path to one, e.g. "model.pt"
+        tokens (torch.Tensor): Input tokens of shape [batch, pos]
+
+    Returns:
+        Dict[str, float]: Max. absolute logit difference and the fraction of matching argmax
+            predictions, for the original weights and for weights round-tripped through
+            FastTransformer
+    """
+    if isinstance(state_dict, str):
+        state_dict = torch.load(state_dict, map_location=cfg.device)
+    hooked_model = HookedTransformer(cfg)
+    hooked_model.load_state_dict(state_dict)
+    fast_model = FastTransformer.from_hooked(hooked_model)
+    round_trip_model = fast_model.to_hooked()
+    tokens = tokens.to(cfg.device)
+    with torch.no_grad():
+        hooked_logits = hooked_model(tokens)
+        fast_logits = fast_model(tokens)
+        round_trip_logits = round_trip_model(tokens)
+    return {
+        "max_abs_diff": (hooked_logits - fast_logits).abs().max().item(),
+        "argmax_agreement": (hooked_logits.argmax(-1) == fast_logits.argmax(-1)).float().mean().item(),
+        "round_trip_max_abs_diff": (hooked_logits - round_trip_logits).abs().max().item(),
+    }
+
@@ -105,7 +105,8 @@ def plot_activations(patching_result, clean_tokens, dataset):
     imshow(patching_result, x=token_labels, xaxis="Position", yaxis="Layer", title="Activation patching")
 
 
-def aggregate_activations(model, dataset, activation_keys, n_samples, path_length=None, order="backward"):
+def aggregate_activations(model, dataset, activation_keys, n_samples, path_length=None, order="backward",
+                          precision="fp32"):
     # Collect activations for examples
     agg_cache = {ak: [] for ak in activation_keys}
     graphs = []
@@ -117,14 +118,14 @@ def aggregate_activations(model, dataset, activation_keys, n_samples, path_lengt
             path_length=path_length,
             order=order
         )
-        correct = is_model_correct(model, dataset, test_graph)
+        correct = is_model_correct(model, dataset, test_graph, precision=precision)
         if not correct:
             continue
-        labels, cache = get_example_cache(test_graph, model, dataset)
-        # Record information
+        labels, cache = get_example_cache(test_graph, model, dataset, precision=precision)
+        # Record information, in fp32 for the probes
         graphs.append(test_graph)
         for key in activation_keys:
-            agg_cache[key].append(cache[key].cpu())
+            agg_cache[key].append(cache[key].float().cpu())
     return agg_cache, graphs
 
 
@@ -0,0 +1,156 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+class JSONLBackend:
+    """Appends one JSON record per call to a local file."""
+
+    def __init__(self, file_name):
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        self.file = open(file_name, "a")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def log(self, metrics, step):
+        self.write({"time": time.time(), "step": step, **metrics})
+
+    def log_artifact(self, path, name):
+        self.write({"time": time.time(), "artifact": name, "path": path})
+
+    def close(self):
+        self.file.close()
+
+
+class SQLiteBackend:
+    """Stores metrics as (step, name, value) rows and artifacts as (name, path) rows."""
+
+    def __init__(self, file_name):
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        # Created on the logging thread, so no need to share it with others
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metrics (time REAL, step INTEGER, name TEXT, value REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS artifacts (time REAL, name TEXT, path TEXT)")
+
+    def log(self, metrics, step):
+        now = time.time()
+        self.connection.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?)",
+                                    [(now, step, name, value) for name, value in metrics.items()])
+        self.connection.commit()
+
+    def log_artifact(self, path, name):
+        self.connection.execute("INSERT INTO artifacts VALUES (?, ?, ?)", (time.time(), name, path))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class WandbBackend:
+    """Forwards metrics and checkpoint files to Weights & Biases. wandb is only imported here."""
+
+    def __init__(self, project, name, config=None):
+        import wandb
+        self.wandb = wandb
+        self.name = name
+        self.run = wandb.init(project=project, name=name, config=config)
+
+    def log(self, metrics, step):
+        self.wandb.log(metrics, step=step)
+
+    def log_artifact(self, path, name):
+        artifact = self.wandb.Artifact(self.name, type="model")
+        artifact.add_file(local_path=path, name=name)
+        self.wandb.log_artifact(artifact)
+
+    def close(self):
+        self.run.finish()
+
+
+class MetricsLogger:
+    """Passes metrics and artifacts to one or more backends from a background thread, so
+    logging never blocks the caller. Backends are given as zero-argument factories and
+    built on that thread, as e.g. sqlite connections are tied to the thread creating them.
+
+    Errors raised by a backend are re-raised by the next call to log() or by close().
+    """
+
+    def __init__(self, backend_factories):
+        self.queue = queue.Queue()
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(backend_factories,), daemon=True)
+        self.thread.start()
+        # Surface setup errors, e.g. a missing wandb install, right away
+        self.ready.wait()
+        self.raise_error()
+
+    def run(self, backend_factories):
+        try:
+            backends = [factory() for factory in backend_factories]
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            method, args = item
+            for backend in backends:
+                try:
+                    getattr(backend, method)(*args)
+                except Exception as e:
+                    self.error = e
+        for backend in backends:
+            backend.close()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def log(self, metrics, step):
+        self.raise_error()
+        self.queue.put(("log", (metrics, step)))
+
+    def log_artifact(self, path, name):
+        self.queue.put(("log_artifact", (path, name)))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+
+def get_logger(save_path, backend="jsonl", use_wandb=False, project=None, name=None, config=None):
+    """Build a MetricsLogger writing to 'save_path' and optionally to wandb.
+
+    Args:
+        save_path (str): Run directory, the local log is written to metrics.jsonl / metrics.db in it
+        backend (str, optional): Local backend, "jsonl", "sqlite" or None. Defaults to "jsonl".
+        use_wandb (bool, optional): Also log to wandb. Defaults to False.
+        project (str, optional): wandb project
+        name (str, optional): wandb run name
+        config (dict, optional): wandb run config
+
+    Returns:
+        MetricsLogger: The logger
+    """
+    factories = []
+    if backend == "jsonl":
+        factories.append(lambda: JSONLBackend(os.path.join(save_path, "metrics.jsonl")))
+    elif backend == "sqlite":
+        factories.append(lambda: SQLiteBackend(os.path.join(save_path, "metrics.db")))
+    elif backend is not None:
+        raise ValueError(f"Unknown logging backend {backend}")
+    if use_wandb:
+        factories.append(lambda: WandbBackend(project, name, config))
+    return MetricsLogger(factories)
@@ -4,6 +4,8 @@ from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_sc
 from torch import nn, optim
 from torch.utils.data import DataLoader, TensorDataset, random_split
 
+from .utils import get_device
+
 
 class Probe:
     
@@ -13,14 +15,14 @@ class Probe:
         batch_size: int = 2048,
         max_iter: int = 200,
         verbose: bool = False,
-        device: str = "cuda",
+        device: str = None,
     ):
         self.model = None
         self.learning_rate_init = learning_rate_init
         self.max_iter = max_iter
         self.batch_size = batch_size
         self.verbose = verbose
-        self.device = device
+        self.device = get_device(device)
 
     def construct_model(self, input_dim, output_dim):
         assert NotImplementedError("Model not defined")
@@ -30,7 +32,7 @@ class Probe:
         torch.save(self.model, filename)
         
     def load(self, filename):
-        self.model = torch.load(filename)
+        self.model = torch.load(filename, map_location=self.device)
 
     def fix_inputs(self, *args):
         # All inputs to tensors
@@ -216,7 +218,7 @@ class MultiClsProbe(Probe):
         return torch.nn.functional.binary_cross_entropy_with_logits(
             input=pred,
             target=y,
-            pos_weight=torch.tensor([1.0]).to('cuda')
+            pos_weight=torch.tensor([1.0], device=pred.device)
         )
 
     def get_acc(self, y, pred):
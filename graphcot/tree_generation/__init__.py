@@ -1,3 +1,3 @@
-from .gen import generate_example, generate_example_secondary_path
+from .gen import generate_example, generate_example_secondary_path, generate_examples, sample_tree_graphs
 from .viz import hierarchy_pos, parse_example
-from .dataset import GraphDataset
+from .dataset import GraphDataset, StreamingGraphDataset
@@ -1,91 +1,504 @@
+import hashlib
+import itertools
+import json
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from tqdm import tqdm
 
 from . import generate_example, generate_example_secondary_path, parse_example
+from .gen import create_vocab, vocab_token_ids
 
 
-def generate_dataset_file(n_states, file_name, n_examples, start_seed=0):
-    """Generate dataset file if it does not exist
+def generate_dataset_line(n_states, seed, return_tokens=False):
+    """Generate the dataset line for a single seed
+
+    Args:
+        n_states (int): Number of nodes per tree
+        seed (int): Seed of the example
+        return_tokens (bool, optional): Whether to return the token array instead of the string. Defaults to False.
+    """
+    if seed % 2 == 0:
+        order = "backward"
+    else:
+        order = "random"
+    return generate_example_secondary_path(
+        n_states=n_states,
+        seed=seed,
+        order=order,
+        return_tokens=return_tokens
+    )
+
+
+def generate_dataset_tokens(n_states, n_examples, start_seed=0, out=None):
+    """Generate the tokens of the dataset lines for the seeds in
+    [start_seed, start_seed + n_examples) without going through strings
+
+    Args:
+        n_states (int): Number of nodes per tree
+        n_examples (int): Number of different examples to sample
+        start_seed (int, optional): Seed of the first example. Defaults to 0.
+        out (np.ndarray, optional): Preallocated [n_examples, n_states * 4 + 2] array to fill. Defaults to None.
+
+    Returns:
+        np.ndarray: Token array of every example, uint8 unless the vocab needs more
+    """
+    if out is None:
+        _, _, dtype = vocab_token_ids(n_states)
+        out = np.empty((n_examples, n_states * 4 + 2), dtype=dtype)
+    assert out.shape == (n_examples, n_states * 4 + 2)
+    for idx in range(n_examples):
+        out[idx] = generate_dataset_line(n_states, start_seed + idx, return_tokens=True)
+    return out
+
+
+def generate_dataset_shard(n_states, file_name, start_seed, stop_seed):
+    """Write the examples for the seeds in [start_seed, stop_seed) to a file
+
+    Args:
+        n_states (int): Number of nodes per tree
+        file_name (str): Name of file to save the shard in
+        start_seed (int): First seed of the shard
+        stop_seed (int): Seed after the last seed of the shard
+    """
+    with open(file_name, "w") as f:
+        for seed in range(start_seed, stop_seed):
+            f.write(generate_dataset_line(n_states, seed)+"\n")
+    return file_name
+
+
+def resume_dataset_file(n_states, file_name, n_examples, start_seed):
+    """Verify a partially or fully generated dataset file against its manifest and
+    truncate it to the last checkpoint
+
+    Args:
+        n_states (int): Number of nodes per tree
+        file_name (str): Name of file the dataset is saved in
+        n_examples (int): Number of different examples to sample
+        start_seed (int): Seed of the first example
+
+    Returns:
+        Returns the first seed that still has to be generated and the sha256 state
+        of the file contents before it
+    """
+    manifest_name = f"{file_name}.manifest.json"
+    hasher = hashlib.sha256()
+    if not (os.path.exists(file_name) and os.path.exists(manifest_name)):
+        return start_seed, hasher
+    with open(manifest_name, "r") as f:
+        manifest = json.load(f)
+    # Only resume a file that was generated with the same parameters
+    if (manifest["n_states"] != n_states or manifest["start_seed"] != start_seed
+            or manifest["next_seed"] > start_seed + n_examples
+            or os.path.getsize(file_name) < manifest["n_bytes"]):
+        return start_seed, hasher
+    with open(file_name, "rb") as f:
+        remaining = manifest["n_bytes"]
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    if hasher.hexdigest() != manifest["checksum"]:
+        return start_seed, hashlib.sha256()
+    # Drop lines written after the last checkpoint
+    with open(file_name, "r+b") as f:
+        f.truncate(manifest["n_bytes"])
+    return manifest["next_seed"], hasher
+
+
+def write_dataset_manifest(n_states, file_name, start_seed, next_seed, f, hasher):
+    """Checkpoint the dataset file: flush it to disk and atomically replace its manifest
+
+    Args:
+        n_states (int): Number of nodes per tree
+        file_name (str): Name of file the dataset is saved in
+        start_seed (int): Seed of the first example
+        next_seed (int): Seed after the last example in the file
+        f (BinaryIO): Open handle of the dataset file
+        hasher (hashlib._Hash): sha256 state of the file contents
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    manifest = {
+        "n_states": n_states,
+        "start_seed": start_seed,
+        "next_seed": next_seed,
+        "n_bytes": f.tell(),
+        "checksum": hasher.hexdigest(),
+    }
+    manifest_name = f"{file_name}.manifest.json"
+    with open(manifest_name + ".tmp", "w") as mf:
+        json.dump(manifest, mf)
+    os.replace(manifest_name + ".tmp", manifest_name)
+
+
+def generate_dataset_file(n_states, file_name, n_examples, start_seed=0, n_workers=1, checkpoint_every=10_000):
+    """Generate dataset file if it does not exist. Progress is recorded in a manifest
+    next to the file, so an interrupted run resumes from the last checkpoint and a
+    finished file is reused.
 
     Args:
         n_states (int): Number of nodes per tree
         file_name (str): Name of file to save dataset in
         n_examples (int): Number of different examples to sample
+        start_seed (int, optional): Seed of the first example. Defaults to 0.
+        n_workers (int, optional): Number of processes to generate shards with. The
+        output is identical to serial generation. Defaults to 1.
+        checkpoint_every (int, optional): Examples between checkpoints when generating serially. Defaults to 10_000.
     """
-    if os.path.exists(file_name) and False:
+    stop_seed = start_seed + n_examples
+    next_seed, hasher = resume_dataset_file(n_states, file_name, n_examples, start_seed)
+    if next_seed == stop_seed:
         print("Loading contents from file...")
+        return
+    if next_seed > start_seed:
+        print(f"Resuming file from seed {next_seed}...")
+        mode = "ab"
     else:
-        print("Generating file...")
-        with open(file_name, "w") as f:
-            for seed in tqdm(range(start_seed, n_examples+start_seed)):
-                if seed % 2 == 0:
-                    order = "backward"
-                else:
-                    order = "random"
-                line = generate_example_secondary_path(
-                    n_states=n_states,
-                    seed=seed,
-                    order=order
-                )
-                f.write(line+"\n")
-
-
-class GraphDataset(Dataset):
-    
-    def __init__(self, n_states, file_name, n_examples, seed=0):
+        mode = "wb"
+    with open(file_name, mode) as f:
+        if n_workers > 1:
+            print(f"Generating file with {n_workers} workers...")
+            generate_dataset_file_parallel(n_states, file_name, next_seed, stop_seed, n_workers, f, hasher, start_seed)
+        else:
+            print("Generating file...")
+            for seed in tqdm(range(next_seed, stop_seed), initial=next_seed-start_seed, total=n_examples):
+                line = (generate_dataset_line(n_states, seed)+"\n").encode()
+                f.write(line)
+                hasher.update(line)
+                if (seed + 1 - start_seed) % checkpoint_every == 0 or seed + 1 == stop_seed:
+                    write_dataset_manifest(n_states, file_name, start_seed, seed + 1, f, hasher)
+
+
+def generate_dataset_file_parallel(n_states, file_name, next_seed, stop_seed, n_workers, f, hasher, start_seed, shards_per_worker=4):
+    """Generate the seeds in [next_seed, stop_seed) by splitting them into shards,
+    generating them in a process pool and appending them to the dataset file in seed
+    order. The manifest is checkpointed after every appended shard.
+
+    Args:
+        n_states (int): Number of nodes per tree
+        file_name (str): Name of file to save dataset in
+        next_seed (int): First seed to generate
+        stop_seed (int): Seed after the last seed to generate
+        n_workers (int): Number of processes
+        f (BinaryIO): Open handle of the dataset file
+        hasher (hashlib._Hash): sha256 state of the file contents
+        start_seed (int): Seed of the first example in the file
+        shards_per_worker (int, optional): Shards per process, for load balancing. Defaults to 4.
+    """
+    # Split seed range into contiguous shards
+    n_shards = max(1, min(stop_seed - next_seed, n_workers * shards_per_worker))
+    bounds = [int(b) for b in np.linspace(next_seed, stop_seed, n_shards + 1)]
+    shard_files = [f"{file_name}.shard{idx}" for idx in range(n_shards)]
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(generate_dataset_shard, n_states, shard_file, start, stop)
+                for shard_file, start, stop in zip(shard_files, bounds[:-1], bounds[1:])
+            ]
+            # Append shards in seed order as soon as they are done
+            for future, stop in tqdm(zip(futures, bounds[1:]), total=n_shards):
+                shard_file = future.result()
+                with open(shard_file, "rb") as shard:
+                    for chunk in iter(lambda: shard.read(1 << 20), b""):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                os.remove(shard_file)
+                write_dataset_manifest(n_states, file_name, start_seed, stop, f, hasher)
+    finally:
+        for shard_file in shard_files:
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+
+
+class GraphTokenizer:
+    """Vocabulary and tokenization shared by the graph datasets"""
+
+    def __init__(self, n_states):
         # Create a list of vocab
-        number_tokens = sorted([str(i) for i in range(n_states)], key=lambda x: len(x), reverse=True)
         self.n_states = n_states
-        self.idx2tokens = [",", ":", "|"] + [f">{t}" for t in number_tokens] + number_tokens
+        self.idx2tokens = create_vocab(n_states)
         self.tokens2idx = {token: idx for idx, token in enumerate(self.idx2tokens)}
+        self.token_pattern = re.compile("|".join(re.escape(token) for token in self.idx2tokens))
+        self.batch_token_pattern = re.compile(self.token_pattern.pattern + "|\n")
+        self.batch_tokens2idx = {**self.tokens2idx, "\n": -1}
         self.max_seq_length = n_states * 4 + 2
         self.pad_token = self.tokens2idx[","]
         self.start_token = 1
-        # Open up dataset file and load+tokenize strings
-        self.X = []
-        self.masks = []
-        generate_dataset_file(n_states, file_name, n_examples, seed)
-        with open(file_name, "r") as f:
-            for line in f.readlines():
-                # Tokenize string to integers
-                tokens = self.tokenize(line.rstrip())
-                self.X.append(tokens)
-
-                # Create a mask
-                start_idx = np.where(tokens == 1)[0].item()
-                index_tensor = np.arange(tokens.shape[0])
-                mask = np.zeros_like(tokens, dtype=bool)
-                mask[start_idx+2:len(tokens)+2] = True
-                self.masks.append(mask)
-        # Stack arrays
-        self.X = torch.from_numpy(np.stack(self.X))
-        self.masks = torch.from_numpy(np.stack(self.masks))
-        
+
     def tokenize(self, text):
-        # Convert to token list
-        tokens = []
-        i = 0
-        while i < len(text):
-            for idx, word in enumerate(self.idx2tokens):
-                if text.startswith(word, i):
-                    tokens.append(idx)
-                    i += len(word)
-                    break
-            else:
-                i += 1
+        # Convert to token list, the alternation tries tokens in vocab order like a startswith scan
+        tokens = [self.tokens2idx[word] for word in self.token_pattern.findall(text)]
         # Convert to fixed length numpy array
         tokens_arr = np.array(tokens)
         padding_length = self.max_seq_length - len(tokens)
         tokens_arr = np.pad(tokens_arr, ((0, padding_length),), mode='constant', constant_values=0)
         return tokens_arr
 
+    def tokenize_batch(self, texts, dtype=np.int64):
+        """Tokenize many examples into one padded array with a single regex pass
+
+        Args:
+            texts (List[str]): Example strings, one per row
+            dtype (np.dtype, optional): Dtype of the token array. Defaults to np.int64.
+
+        Returns:
+            np.ndarray: Token array of shape [len(texts), max_seq_length]
+        """
+        # Newlines mark the end of every example
+        text = "\n".join(texts) + "\n"
+        words = self.batch_token_pattern.findall(text)
+        ids = np.fromiter(map(self.batch_tokens2idx.__getitem__, words), dtype=np.int64, count=len(words))
+        ends = np.flatnonzero(ids < 0)
+        lengths = np.diff(ends, prepend=-1) - 1
+        if len(lengths) and lengths.max() > self.max_seq_length:
+            raise ValueError(f"Example with {lengths.max()} tokens exceeds max_seq_length {self.max_seq_length}")
+        # Scatter the tokens of every example into its padded row
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        tokens_arr = np.zeros((len(lengths), self.max_seq_length), dtype=dtype)
+        tokens_arr[rows, cols] = ids[ids >= 0]
+        return tokens_arr
+
+    def tokenize_file(self, file_name, dtype=np.int64):
+        # Tokenize every line of a dataset file
+        with open(file_name, "r") as f:
+            return self.tokenize_batch(f.read().splitlines(), dtype)
+
     def untokenize(self, tokens):
         substrings = [self.idx2tokens[idx] for idx in tokens]
         return "".join(substrings)
+
+    def create_mask(self, tokens):
+        # Loss is computed on the path, starting after the first path node
+        start_idx = np.where(tokens == self.start_token)[0].item()
+        mask = np.zeros_like(tokens, dtype=bool)
+        mask[start_idx+2:len(tokens)+2] = True
+        return mask
+
+    def create_masks(self, X):
+        # Same as create_mask for every row of a token matrix
+        start_idx = np.argmax(X == self.start_token, axis=1)
+        return np.arange(X.shape[1])[None, :] >= start_idx[:, None] + 2
+
+    def compute_metadata(self, X):
+        """Compute per-example metadata columns from a token matrix
+
+        Args:
+            X (np.ndarray): Token matrix of shape [N, max_seq_length]
+
+        Returns:
+            Dict[str, np.ndarray]: Columns of length N, see GraphDataset.load_metadata
+        """
+        node_ids, arrow_ids, _ = vocab_token_ids(self.n_states)
+        n_states = self.n_states
+        # Map token ids back to nodes, -1 for other tokens
+        node_of = np.full((len(self.idx2tokens),), -1, dtype=np.int64)
+        node_of[node_ids] = np.arange(n_states)
+        arrow_of = np.full((len(self.idx2tokens),), -1, dtype=np.int64)
+        arrow_of[arrow_ids] = np.arange(n_states)
+        rows = np.arange(len(X))
+        answer_start = np.argmax(X == self.start_token, axis=1)
+        goal_start = np.argmax(X == self.tokens2idx["|"], axis=1)
+        after_start = np.arange(X.shape[1])[None, :] > answer_start[:, None]
+        path_length = ((arrow_of[X] >= 0) & after_start).sum(axis=1)
+        # Edge k is 'source>target' at positions 3k and 3k+1
+        n_edges = (goal_start + 1) // 3
+        n_slots = min(X[:, 0::3].shape[1], X[:, 1::3].shape[1])
+        edge_idx = np.arange(n_slots)[None, :]
+        valid = edge_idx < n_edges[:, None]
+        sources = np.where(valid, node_of[X[:, 0::3][:, :n_slots]], n_states)
+        targets = np.where(valid, arrow_of[X[:, 1::3][:, :n_slots]], n_states)
+        # Leaves are targets that are never a source, column 'n_states' collects padding
+        is_source = np.zeros((len(X), n_states + 1), dtype=bool)
+        is_source[rows[:, None], sources] = True
+        is_target = np.zeros((len(X), n_states + 1), dtype=bool)
+        is_target[rows[:, None], targets] = True
+        n_leaves = (is_target & ~is_source)[:, :n_states].sum(axis=1)
+        # The parent array is canonical for the edge set, independent of edge order and goal
+        parents = np.full((len(X), n_states + 1), -1, dtype=np.int64)
+        parents[rows[:, None], targets] = sources
+        tree_hash = hash_rows(parents[:, :n_states])
+        # Edges are forward (backward) if each source's incoming edge comes before (after) it
+        parent_edge = np.full((len(X), n_states + 1), -1, dtype=np.int64)
+        parent_edge[rows[:, None], targets] = np.broadcast_to(edge_idx, targets.shape)
+        source_parent_edge = np.take_along_axis(parent_edge, sources, axis=1)
+        is_root = source_parent_edge < 0
+        forward = np.all(~valid | (source_parent_edge < edge_idx), axis=1)
+        backward = np.all(~valid | is_root | (source_parent_edge > edge_idx), axis=1)
+        edge_order = np.where(forward, EDGE_ORDERS.index("forward"), np.where(backward, EDGE_ORDERS.index("backward"), EDGE_ORDERS.index("random")))
+        return {
+            "prompt_length": (answer_start + 2).astype(np.int16),
+            "answer_start": answer_start.astype(np.int16),
+            "path_length": path_length.astype(np.int16),
+            "goal": node_of[X[rows, answer_start - 1]].astype(np.int16),
+            "n_leaves": n_leaves.astype(np.int16),
+            "edge_order": edge_order.astype(np.int8),
+            "tree_hash": tree_hash,
+        }
+
+
+EDGE_ORDERS = ["forward", "backward", "random"]
+METADATA_COLUMNS = ["prompt_length", "answer_start", "path_length", "goal", "n_leaves", "edge_order", "tree_hash"]
+
+
+def hash_rows(arr):
+    """Deterministic 64-bit hash of every row of a non-negative or -1 integer matrix"""
+    # FNV-1a over the entries followed by a splitmix64 finalizer
+    h = np.full((len(arr),), 0xcbf29ce484222325, dtype=np.uint64)
+    for column in (arr + 1).astype(np.uint64).T:
+        h = (h ^ column) * np.uint64(0x100000001b3)
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+class AnswerMasks:
+    """Loss masks derived from the position of ':' instead of being stored.
+    Indexing works like indexing the stacked bool mask tensor."""
+
+    def __init__(self, answer_start, seq_length):
+        self.answer_start = answer_start
+        self.positions = torch.arange(seq_length)
+
+    def __getitem__(self, index):
+        return self.positions >= (self.answer_start[index].to(torch.long) + 2).unsqueeze(-1)
+
+    def __len__(self):
+        return len(self.answer_start)
+
+    @property
+    def shape(self):
+        return torch.Size([len(self.answer_start), len(self.positions)])
+
+
+class GraphDataset(GraphTokenizer, Dataset):
+    
+    def __init__(self, n_states, file_name, n_examples, seed=0, n_workers=1, use_cache=True, memmap=False):
+        """Tokenized dataset of examples read from 'file_name', which is generated if needed
+
+        Args:
+            n_states (int): Number of nodes per tree
+            file_name (str): Name of file the dataset is saved in
+            n_examples (int): Number of different examples to sample
+            seed (int, optional): Seed of the first example. Defaults to 0.
+            n_workers (int, optional): Number of processes to generate the file with. Defaults to 1.
+            use_cache (bool, optional): Whether to cache the tokenized arrays next to the file. Defaults to True.
+            memmap (bool, optional): Whether to memory-map compact uint8 tokens from the cache instead of
+            loading int64 tokens and bool masks into memory. Masks are then derived from the ':' position.
+            Defaults to False.
+        """
+        super().__init__(n_states)
+        # Open up dataset file and load+tokenize strings
+        generate_dataset_file(n_states, file_name, n_examples, seed, n_workers)
+        self.cache_dir = f"{file_name}.cache"
+        self.cache_key = self.get_cache_key(file_name)
+        if memmap:
+            self.load_memmap(file_name)
+        else:
+            self.load_arrays(file_name, use_cache)
+        self.metadata = self.load_metadata(use_cache or memmap)
+
+    def load_arrays(self, file_name, use_cache):
+        X_file = os.path.join(self.cache_dir, f"X_{self.cache_key}.npy")
+        masks_file = os.path.join(self.cache_dir, f"masks_{self.cache_key}.npy")
+        if use_cache and os.path.exists(X_file) and os.path.exists(masks_file):
+            X = np.load(X_file)
+            masks = np.load(masks_file)
+        else:
+            X = self.tokenize_file(file_name)
+            masks = self.create_masks(X)
+            if use_cache:
+                self.save_cache(X_file, masks_file, X, masks)
+        self.X = torch.from_numpy(X)
+        self.masks = torch.from_numpy(masks)
+
+    def load_metadata(self, use_cache, chunk_size=1 << 18):
+        """Load or compute the metadata columns, one entry per example:
+        prompt_length (tokens up to and including the root), answer_start (position of ':'),
+        path_length (edges on the path), goal (goal node), n_leaves (leaves of the tree) and
+        edge_order (index into EDGE_ORDERS, 'random' unless the edges are topologically sorted)
+        and tree_hash (hash of the edge set, equal for the same tree in any edge order or goal)
+        """
+        metadata_file = os.path.join(self.cache_dir, f"metadata_{self.cache_key}.npz")
+        if use_cache and os.path.exists(metadata_file):
+            with np.load(metadata_file) as f:
+                if sorted(f.files) == sorted(METADATA_COLUMNS):
+                    return {key: f[key] for key in f.files}
+        # Compute in chunks so memory-mapped tokens are never fully loaded
+        X = self.X.numpy()
+        chunks = [self.compute_metadata(X[i:i + chunk_size]) for i in range(0, len(X), chunk_size)]
+        metadata = {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+        if use_cache:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(metadata_file + ".tmp", "wb") as f:
+                np.savez(f, **metadata)
+            os.replace(metadata_file + ".tmp", metadata_file)
+        return metadata
+
+    def get_indices(self, **conditions):
+        """Indices of the examples whose metadata columns equal the given values,
+        e.g. dataset.get_indices(path_length=5, edge_order=EDGE_ORDERS.index("backward"))"""
+        selected = np.ones((len(self),), dtype=bool)
+        for key, value in conditions.items():
+            selected &= self.metadata[key] == value
+        return np.flatnonzero(selected)
+
+    def get_cache_key(self, file_name):
+        # Tokens depend on the file contents, the number of nodes and the vocab
+        hasher = hashlib.sha256()
+        with open(file_name, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+        hasher.update(json.dumps([self.n_states, self.idx2tokens]).encode())
+        return hasher.hexdigest()[:16]
+
+    def clear_stale_cache(self):
+        # Remove caches of older file contents or vocabs
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(("X_", "masks_", "tokens_", "answer_start_", "metadata_", "split_")) and self.cache_key not in name:
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def save_cache(self, X_file, masks_file, X, masks):
+        self.clear_stale_cache()
+        # Write atomically so an interrupted save is never loaded
+        for cache_file, arr in [(masks_file, masks), (X_file, X)]:
+            with open(cache_file + ".tmp", "wb") as f:
+                np.save(f, arr)
+            os.replace(cache_file + ".tmp", cache_file)
+
+    def load_memmap(self, file_name, chunk_bytes=1 << 26):
+        tokens_file = os.path.join(self.cache_dir, f"tokens_{self.cache_key}.npy")
+        answer_start_file = os.path.join(self.cache_dir, f"answer_start_{self.cache_key}.npy")
+        if not (os.path.exists(tokens_file) and os.path.exists(answer_start_file)):
+            self.clear_stale_cache()
+            # Count examples, then tokenize the file chunk by chunk straight into the memory map
+            with open(file_name, "rb") as f:
+                n_lines = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+            _, _, dtype = vocab_token_ids(self.n_states)
+            tokens = np.lib.format.open_memmap(tokens_file + ".tmp", mode="w+", dtype=dtype, shape=(n_lines, self.max_seq_length))
+            answer_start = np.lib.format.open_memmap(answer_start_file + ".tmp", mode="w+", dtype=np.int16, shape=(n_lines,))
+            offset = 0
+            with open(file_name, "r") as f:
+                for lines in iter(lambda: f.readlines(chunk_bytes), []):
+                    chunk = self.tokenize_batch([line.rstrip("\n") for line in lines], dtype)
+                    tokens[offset:offset + len(chunk)] = chunk
+                    answer_start[offset:offset + len(chunk)] = np.argmax(chunk == self.start_token, axis=1)
+                    offset += len(chunk)
+            tokens.flush()
+            answer_start.flush()
+            del tokens, answer_start
+            os.replace(answer_start_file + ".tmp", answer_start_file)
+            os.replace(tokens_file + ".tmp", tokens_file)
+        # Copy-on-write maps are writable for torch but never modify the files
+        self.X = torch.from_numpy(np.load(tokens_file, mmap_mode="c"))
+        self.masks = AnswerMasks(torch.from_numpy(np.load(answer_start_file, mmap_mode="c")), self.max_seq_length)
     
     def visualize_example(self, index):
         string = self.untokenize(self[index][0])
@@ -96,3 +509,58 @@ class GraphDataset(Dataset):
 
     def __len__(self):
         return len(self.X)
+
+
+def get_rank_and_world_size():
+    # Rank of this process and the number of processes of a distributed run, (0, 1) otherwise
+    if dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class StreamingGraphDataset(GraphTokenizer, IterableDataset):
+    """Generates and tokenizes examples on the fly instead of reading a dataset file.
+
+    Every DataLoader worker of every distributed rank draws a disjoint, deterministic
+    subset of the seeds, so the stream is the same for any number of workers up to
+    the order of examples. In distributed runs every rank gets n_examples // world_size
+    examples per epoch. With n_examples set, each epoch covers 'n_examples' seeds and
+    set_epoch moves the stream to fresh seeds; without it the stream is unlimited
+    and every epoch starts UNLIMITED_EPOCH_STRIDE seeds further, so train has to be
+    given the number of steps per epoch. A test stream can use a seed far away from
+    the training seeds.
+    """
+
+    # Even, so the alternation of backward and random edge orders is kept
+    UNLIMITED_EPOCH_STRIDE = 2**32
+
+    def __init__(self, n_states, n_examples=None, seed=0):
+        super().__init__(n_states)
+        self.n_examples = n_examples
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rank, world_size = get_rank_and_world_size()
+        # Seeds are dealt out to the workers of all ranks in turn
+        offset, stride = rank * n_workers + worker_id, world_size * n_workers
+        if self.n_examples is None:
+            seeds = itertools.count(self.seed + self.epoch * self.UNLIMITED_EPOCH_STRIDE + offset, stride)
+        else:
+            start_seed = self.seed + self.epoch * self.n_examples
+            # The same number of examples for every rank
+            stop_seed = start_seed + self.n_examples // world_size * world_size
+            seeds = range(start_seed + offset, stop_seed, stride)
+        for seed in seeds:
+            tokens = generate_dataset_line(self.n_states, seed, return_tokens=True)
+            yield torch.from_numpy(tokens), torch.from_numpy(self.create_mask(tokens))
+
+    def __len__(self):
+        if self.n_examples is None:
+            raise TypeError("An unlimited StreamingGraphDataset has no length")
+        return self.n_examples // get_rank_and_world_size()[1]
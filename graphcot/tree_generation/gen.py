@@ -1,30 +1,32 @@
 import random
-from typing import List, Tuple
+from functools import lru_cache, partial
+from typing import Dict, Iterable, List, Set, Tuple, Union
 
 import networkx as nx
 import numpy as np
 
 
-def sample_tree_graph(
+def sample_tree_parents(
     n_states: int,
     path_length: int,
     rng: np.random.Generator,
     is_binary: bool = True
-) -> Tuple[nx.DiGraph, int, int]:
-    """Generate a random tree with the specified params
+) -> Tuple[np.ndarray, int, int]:
+    """Generate a random tree with the specified params as a parent array.
+    Draws from 'rng' exactly like sample_tree_graph, so the same seed gives the same tree.
 
     Args:
         n_states (int): Number of nodes in tree
         path_length (int): Length of path
         rng (np.random.Generator): Random number generator
         is_binary (bool, optional): Whether or not each node can have a 
-        max of two children. Defaults to False.
+        max of two children. Defaults to True.
 
     Returns:
-        Tuple[nx.DiGraph, int, int]: Return the graph, the root, and the goal node
+        Tuple[np.ndarray, int, int]: Return the parent array (-1 marks the root), the root, and the goal node
     """
-    # Create adjacency matrix
-    adj_matrix = np.zeros((n_states, n_states))
+    parents = np.full((n_states,), -1, dtype=np.int64)
+    n_children = [0] * n_states
     source_node = None
     destination_node = None
     nodes = [i for i in range(n_states)]
@@ -33,14 +35,15 @@ def sample_tree_graph(
     # Generate path of defined 'path_length'
     for i in range(path_length + 1):  # '+ 1' as we have to sample the source node first 
         # sample example and remove it from the list of nodes
-        sample_node = rng.choice(nodes, 1)[0]
+        sample_node = nodes[rng.integers(len(nodes))]  # same draw as rng.choice(nodes, 1)[0]
         nodes.remove(sample_node)
         nodes_in_tree.append(sample_node)
-        # construct the edge and add it to the edge list
+        # construct the edge
         if source_node is None:
             source_node = sample_node
         else:
-            adj_matrix[intermediate_node, sample_node] = 1
+            parents[sample_node] = intermediate_node
+            n_children[intermediate_node] += 1
         intermediate_node = sample_node
     destination_node = intermediate_node
     # Add other nodes until requested 'n_states'
@@ -48,16 +51,124 @@ def sample_tree_graph(
     for n in nodes:
         # Sample a position in the tree
         if is_binary:
-            valid_parents = [node for node in nodes_in_tree if adj_matrix[node].sum() < 2]
+            valid_parents = [node for node in nodes_in_tree if n_children[node] < 2]
         else:
             valid_parents = nodes_in_tree
-        connection_node = rng.choice(valid_parents, 1)[0]
+        connection_node = valid_parents[rng.integers(len(valid_parents))]
         # Integrate node
-        adj_matrix[connection_node, n] = 1
+        parents[n] = connection_node
+        n_children[connection_node] += 1
         nodes_in_tree.append(n)
-    # Create networkx object
-    tree = nx.DiGraph(incoming_graph_data=adj_matrix)
-    return tree, source_node, destination_node
+    return parents, source_node, destination_node
+
+
+def parents_to_graph(parents: np.ndarray) -> nx.DiGraph:
+    """Converts a parent array into a NetworkX graph
+
+    Args:
+        parents (np.ndarray): Parent of every node, -1 for the root
+
+    Returns:
+        nx.DiGraph: The tree as a directed graph
+    """
+    n_states = len(parents)
+    adj_matrix = np.zeros((n_states, n_states))
+    children = np.nonzero(parents >= 0)[0]
+    adj_matrix[parents[children], children] = 1
+    return nx.DiGraph(incoming_graph_data=adj_matrix)
+
+
+def sample_tree_graph(
+    n_states: int,
+    path_length: int,
+    rng: np.random.Generator,
+    is_binary: bool = True
+) -> Tuple[nx.DiGraph, int, int]:
+    """Generate a random tree with the specified params
+
+    Args:
+        n_states (int): Number of nodes in tree
+        path_length (int): Length of path
+        rng (np.random.Generator): Random number generator
+        is_binary (bool, optional): Whether or not each node can have a 
+        max of two children. Defaults to False.
+
+    Returns:
+        Tuple[nx.DiGraph, int, int]: Return the graph, the root, and the goal node
+    """
+    parents, source_node, destination_node = sample_tree_parents(n_states, path_length, rng, is_binary)
+    return parents_to_graph(parents), source_node, destination_node
+
+
+def sample_tree_graphs(
+    n_examples: int,
+    n_states: int,
+    rng: np.random.Generator,
+    path_length: Union[int, np.ndarray] = None,
+    is_binary: bool = True
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Generate a batch of random trees at once, represented as parent arrays.
+    Follows the same construction as sample_tree_graph: a root-to-goal path of
+    'path_length' edges is sampled first, then the remaining nodes are attached
+    in ascending order to random nodes already in the tree (never to the goal).
+    The trees follow the same distribution, but are not the trees sample_tree_graph
+    draws from the same generator.
+
+    Args:
+        n_examples (int): Number of trees to sample
+        n_states (int): Number of nodes per tree
+        rng (np.random.Generator): Random number generator
+        path_length (int or np.ndarray, optional): Length of path, either shared
+        or one per tree. Defaults to None, which samples it like generate_example.
+        is_binary (bool, optional): Whether or not each node can have a
+        max of two children. Defaults to True.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Return the parent arrays of shape
+        [n_examples, n_states] (-1 marks the root), the roots and the goal nodes
+    """
+    assert n_states >= 2
+    rows = np.arange(n_examples)
+    if path_length is None:
+        path_length = rng.integers(1, n_states // 3 * 2, size=n_examples)
+    path_length = np.broadcast_to(np.asarray(path_length), (n_examples,))
+    assert np.all((path_length >= 1) & (path_length < n_states))
+    # Each row is a random node order: the first 'path_length + 1' nodes form the path
+    order = rng.permuted(np.tile(np.arange(n_states), (n_examples, 1)), axis=1)
+    on_path = np.arange(n_states)[None, :] <= path_length[:, None]
+    # The other nodes are attached in ascending order like in sample_tree_graph
+    off_path = np.sort(np.where(on_path, n_states, order), axis=1)
+    positions = np.maximum(np.arange(n_states)[None, :] - path_length[:, None] - 1, 0)
+    order = np.where(on_path, order, np.take_along_axis(off_path, positions, axis=1))
+    roots = order[:, 0]
+    goals = order[rows, path_length]
+    parents = np.full((n_examples, n_states), -1, dtype=np.min_scalar_type(-n_states))
+    chain = on_path[:, 1:]
+    chain_rows = np.nonzero(chain)[0]
+    parents[chain_rows, order[:, 1:][chain]] = order[:, :-1][chain]
+    # Track which nodes can still receive children
+    n_children = np.zeros((n_examples, n_states), dtype=np.int8)
+    n_children[chain_rows, order[:, :-1][chain]] = 1
+    in_tree = np.zeros((n_examples, n_states), dtype=bool)
+    in_tree[np.nonzero(on_path)[0], order[on_path]] = True
+    in_tree[rows, goals] = False  # ensure we don't increase path length
+    # Attach the remaining nodes one position at a time for all trees in parallel
+    for k in range(2, n_states):
+        active = k > path_length
+        if not active.any():
+            continue
+        valid = in_tree & (n_children < 2) if is_binary else in_tree
+        # Pick uniformly among the valid parents of every row
+        cumulative = np.cumsum(valid, axis=1)
+        pick = (rng.random(n_examples) * cumulative[:, -1]).astype(np.int64)
+        connection_node = (cumulative <= pick[:, None]).sum(axis=1)
+        # Integrate nodes
+        active_rows = rows[active]
+        child = order[active_rows, k]
+        parents[active_rows, child] = connection_node[active]
+        n_children[active_rows, connection_node[active]] += 1
+        in_tree[active_rows, child] = True
+    return parents, roots, goals
 
 
 def topological_sort_edges(graph: nx.DiGraph) -> List[Tuple[int, int]]:
@@ -83,6 +194,41 @@ def topological_sort_edges(graph: nx.DiGraph) -> List[Tuple[int, int]]:
         return None
 
 
+def tree_edges_and_paths(
+    parents: np.ndarray,
+    root: int
+) -> Tuple[List[Tuple[int, int]], Dict[int, List[int]]]:
+    """Does a single BFS over a tree given as a parent array. Produces the same
+    edge order as topological_sort_edges and the same paths as shortest_path.
+
+    Args:
+        parents (np.ndarray): Parent of every node, -1 for the root
+        root (int): Root node of the tree
+
+    Returns:
+        Tuple[List[Tuple[int, int]], Dict[int, List[int]]]: Sorted edgelist, and a
+        dict mapping every leaf node to the path from the root to that leaf
+    """
+    # Children in ascending order, matching the adjacency order of the NetworkX graph
+    children = [[] for _ in range(len(parents))]
+    for node, parent in enumerate(parents):
+        if parent >= 0:
+            children[parent].append(node)
+    # Visiting nodes level by level reproduces nx.topological_sort on a tree
+    edgelist = []
+    paths = {root: [root]}
+    leaf_paths = {}
+    queue = [root]
+    for node in queue:
+        if not children[node]:
+            leaf_paths[node] = paths[node]
+        for child in children[node]:
+            edgelist.append((node, child))
+            paths[child] = paths[node] + [child]
+            queue.append(child)
+    return edgelist, leaf_paths
+
+
 def shortest_path(
     edgelist: List[Tuple[int, int]],
     n_nodes: int,
@@ -119,13 +265,122 @@ def shortest_path(
     return -1  # Path not found
 
 
+def edgelist_leaf_nodes(edgelist: List[Tuple[int, int]]) -> Set[int]:
+    """Finds the leaf nodes of a tree from its edgelist. The iteration order of
+    the returned set depends on the edge order, and decides the order of the
+    examples returned with return_all_leafs.
+
+    Args:
+        edgelist (List[Tuple[int, int]]): List of edges
+
+    Returns:
+        Set[int]: Nodes without outgoing edges
+    """
+    source_nodes = set([source for source, target in edgelist])
+    target_nodes = set([target for source, target in edgelist])
+    return target_nodes - source_nodes
+
+
+def format_examples(
+    edgelist: List[Tuple[int, int]],
+    leaf_paths: Dict[int, List[int]],
+    end_nodes: Iterable[int]
+) -> Dict[int, str]:
+    """Converts a tree into example strings, one per requested end node. The
+    edgelist prefix is shared between all examples and only built once.
+
+    Args:
+        edgelist (List[Tuple[int, int]]): List of edges in prompt order
+        leaf_paths (Dict[int, List[int]]): Path from the root to every leaf, see tree_edges_and_paths
+        end_nodes (Iterable[int]): Goal nodes to create examples for
+
+    Returns:
+        Dict[int, str]: Example string for every end node
+    """
+    prefix = ",".join([f"{i}>{j}" for i, j in edgelist])
+    examples = {}
+    for end_node in end_nodes:
+        path = ">".join([str(p) for p in leaf_paths[end_node]])
+        examples[end_node] = f"{prefix}|{end_node}:{path}"
+    return examples
+
+
+def create_vocab(n_states: int) -> List[str]:
+    """Creates the token vocabulary for trees with 'n_states' nodes. Multi-digit
+    nodes come before single-digit ones, so greedy matching takes the longest node.
+
+    Args:
+        n_states (int): Number of nodes in graph
+
+    Returns:
+        List[str]: Token string of every token id
+    """
+    number_tokens = sorted([str(i) for i in range(n_states)], key=lambda x: len(x), reverse=True)
+    return [",", ":", "|"] + [f">{t}" for t in number_tokens] + number_tokens
+
+
+@lru_cache(maxsize=None)
+def vocab_token_ids(n_states: int) -> Tuple[np.ndarray, np.ndarray, np.dtype]:
+    """Looks up the token ids used to encode examples directly
+
+    Args:
+        n_states (int): Number of nodes in graph
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.dtype]: Id of the token of every node, id
+        of the '>node' token of every node, and the smallest dtype that fits all ids
+    """
+    tokens2idx = {token: idx for idx, token in enumerate(create_vocab(n_states))}
+    node_ids = np.array([tokens2idx[str(i)] for i in range(n_states)])
+    arrow_ids = np.array([tokens2idx[f">{i}"] for i in range(n_states)])
+    return node_ids, arrow_ids, np.min_scalar_type(len(tokens2idx) - 1)
+
+
+def format_tokens(
+    edgelist: List[Tuple[int, int]],
+    leaf_paths: Dict[int, List[int]],
+    end_nodes: Iterable[int],
+    n_states: int
+) -> Dict[int, np.ndarray]:
+    """Converts a tree into padded token arrays, one per requested end node. Gives
+    the same ids as tokenizing the strings of format_examples with GraphDataset.
+
+    Args:
+        edgelist (List[Tuple[int, int]]): List of edges in prompt order
+        leaf_paths (Dict[int, List[int]]): Path from the root to every leaf, see tree_edges_and_paths
+        end_nodes (Iterable[int]): Goal nodes to create examples for
+        n_states (int): Number of nodes in graph
+
+    Returns:
+        Dict[int, np.ndarray]: Token array of length n_states * 4 + 2 for every end node
+    """
+    node_ids, arrow_ids, dtype = vocab_token_ids(n_states)
+    # Edge 'i>j' becomes [i, >j] and edges are separated by ','
+    edges = np.array(edgelist).reshape(-1, 2)
+    prefix = np.zeros((len(edges), 3), dtype=dtype)
+    prefix[:, 0] = node_ids[edges[:, 0]]
+    prefix[:, 1] = arrow_ids[edges[:, 1]]
+    prefix = prefix.reshape(-1)[:-1]
+    examples = {}
+    for end_node in end_nodes:
+        path = leaf_paths[end_node]
+        tokens = np.zeros((n_states * 4 + 2,), dtype=dtype)  # ',' pads the sequence
+        tokens[:len(prefix)] = prefix
+        # '|', goal, ':', first node, '>node' for the rest of the path
+        tokens[len(prefix):len(prefix) + 4] = [2, node_ids[end_node], 1, node_ids[path[0]]]
+        tokens[len(prefix) + 4:len(prefix) + 3 + len(path)] = arrow_ids[path[1:]]
+        examples[end_node] = tokens
+    return examples
+
+
 def generate_example(
     n_states: int,
     seed: int,
     order: str = "random",
     path_length: int = None,
     return_all_leafs: bool = False,
-    is_binary: bool = True
+    is_binary: bool = True,
+    return_tokens: bool = False
 ):
     """Generates a random example involving an edgelist of a tree, a leaf node, and a path from the root node to the leaf
 
@@ -136,10 +391,12 @@ def generate_example(
         path_length (int, optional): Distance between root and goal in example. Defaults to None.
         return_all_leafs (bool, optional): Whether to return all possible path. Defaults to False.
         is_binary (bool, optional): Whether or not the tree should be binary. Defaults to False.
+        return_tokens (bool, optional): Whether to return token arrays instead of strings. Defaults to False.
 
     Returns:
         Returns single string by default
         Returns a list of all possible example strings if return_all_leafs is True
+        Returns token arrays in place of strings if return_tokens is True
     """
     assert n_states >= 2
     assert path_length is None or path_length < n_states
@@ -148,40 +405,71 @@ def generate_example(
     rng = np.random.default_rng(seed=seed)
     if path_length is None:
         path_length = rng.integers(1, n_states // 3 * 2)
-    graph, start_node, goal = sample_tree_graph(n_states, path_length, rng, is_binary)
-    edgelist = topological_sort_edges(graph)
+    parents, start_node, goal = sample_tree_parents(n_states, path_length, rng, is_binary)
+    edgelist, leaf_paths = tree_edges_and_paths(parents, start_node)
     if order == "random":
         rng.shuffle(edgelist)
     elif order == "backward":
         edgelist = edgelist[::-1]
-    # Create all possible examples from edgelist
-    source_nodes = set([source for source, target in edgelist])
-    target_nodes = set([target for source, target in edgelist])
-    leaf_nodes = target_nodes - source_nodes
-    # Sample all possible paths
-    examples = {}
-    for end_node in list(leaf_nodes):
-        path = shortest_path(edgelist, n_states, start_node, end_node)
-        # Convert to a series of tokens
-        string = ",".join([f"{i}>{j}" for i, j in edgelist])
-        string = string + f"|{end_node}:"
-        string = string + ">".join([str(p) for p in path])
-        examples[end_node] = string
+    format_fn = partial(format_tokens, n_states=n_states) if return_tokens else format_examples
     # Return all leafs if specified
     if return_all_leafs:
-        return list(examples.values())
+        return list(format_fn(edgelist, leaf_paths, edgelist_leaf_nodes(edgelist)).values())
     else:
-        return examples[goal]
+        return format_fn(edgelist, leaf_paths, [goal])[goal]
 
 
-def sample_tree_graph_secondary_path(
+def generate_examples(
+    n_examples: int,
+    n_states: int,
+    seed: int,
+    order: str = "random",
+    path_length: Union[int, np.ndarray] = None,
+    is_binary: bool = True,
+    return_tokens: bool = False
+) -> list:
+    """Generates a batch of examples like generate_example, sampling all trees at once
+    with sample_tree_graphs. The examples come from a single rng seeded by 'seed', so
+    they follow the distribution of generate_example but are not its examples for
+    any particular seeds.
+
+    Args:
+        n_examples (int): Number of examples
+        n_states (int): Number of nodes in graph
+        seed (int): Seed for the rng that generates all graphs
+        order (str, optional): The order of the edges in the edgelist. Defaults to "random".
+        path_length (int or np.ndarray, optional): Distance between root and goal, either shared
+        or one per example. Defaults to None, which samples it like generate_example.
+        is_binary (bool, optional): Whether or not the trees should be binary. Defaults to True.
+        return_tokens (bool, optional): Whether to return token arrays instead of strings. Defaults to False.
+
+    Returns:
+        list: Example string, or token array if return_tokens is True, of every example
+    """
+    assert order in ["forward", "backward", "random"]
+    rng = np.random.default_rng(seed=seed)
+    parents, roots, goals = sample_tree_graphs(n_examples, n_states, rng, path_length, is_binary)
+    format_fn = partial(format_tokens, n_states=n_states) if return_tokens else format_examples
+    examples = []
+    for tree_parents, start_node, goal in zip(parents, roots.tolist(), goals.tolist()):
+        edgelist, leaf_paths = tree_edges_and_paths(tree_parents.tolist(), start_node)
+        if order == "random":
+            rng.shuffle(edgelist)
+        elif order == "backward":
+            edgelist = edgelist[::-1]
+        examples.append(format_fn(edgelist, leaf_paths, [goal])[goal])
+    return examples
+
+
+def sample_tree_parents_secondary_path(
     n_states: int,
     path_length: int,
     rng: np.random.Generator,
     is_binary: bool = True,
     second_path_min_length: int = None,
 ):
-    """Generate a random tree with the specified params
+    """Generate a random tree with a second path from the root, as a parent array.
+    Draws from 'rng' exactly like sample_tree_graph_secondary_path.
 
     Args:
         n_states (int): Number of nodes in tree
@@ -191,10 +479,11 @@ def sample_tree_graph_secondary_path(
         max of two children. Defaults to False.
 
     Returns:
-        Tuple[nx.DiGraph, int, int]: Return the graph, the root, and the goal node
+        Return the parent array (-1 marks the root), the root, the goal node,
+        and the first and last node of the second path
     """
-    # Create adjacency matrix
-    adj_matrix = np.zeros((n_states, n_states))
+    parents = np.full((n_states,), -1, dtype=np.int64)
+    n_children = [0] * n_states
     source_node = None
     destination_node = None
     second_source = None
@@ -205,47 +494,72 @@ def sample_tree_graph_secondary_path(
     # Generate path of defined 'path_length'
     for i in range(path_length + 1):  # '+ 1' as we have to sample the source node first 
         # sample example and remove it from the list of nodes
-        sample_node = rng.choice(nodes, 1)[0]
+        sample_node = nodes[rng.integers(len(nodes))]  # same draw as rng.choice(nodes, 1)[0]
         nodes.remove(sample_node)
         nodes_in_tree.append(sample_node)
         # construct the edge and add it to the edge list
         if source_node is None:
             source_node = sample_node
         else:
-            adj_matrix[intermediate_node, sample_node] = 1
+            parents[sample_node] = intermediate_node
+            n_children[intermediate_node] += 1
         intermediate_node = sample_node
     destination_node = intermediate_node
     # Add other nodes until requested 'n_states'
     nodes_in_tree.remove(destination_node)  # remove destination to ensure we don't increase path length
     if second_path_min_length is not None and len(nodes)>=second_path_min_length:
         for i in range(second_path_min_length):
-            sample_node = rng.choice(nodes, 1)[0]
+            sample_node = nodes[rng.integers(len(nodes))]
             nodes.remove(sample_node)
             nodes_in_tree.append(sample_node)
             if second_source is None:
-                adj_matrix[source_node, sample_node] = 1
+                parents[sample_node] = source_node
+                n_children[source_node] += 1
                 second_source = sample_node
             else:
-                adj_matrix[intermediate_node, sample_node] = 1
-            intermediate_node = sample_node  
+                parents[sample_node] = intermediate_node
+                n_children[intermediate_node] += 1
+            intermediate_node = sample_node
         second_path_destination_node = intermediate_node      
              
     for n in nodes:
         # Sample a position in the tree
         if is_binary:
-            valid_parents = [node for node in nodes_in_tree if adj_matrix[node].sum() < 2]
+            valid_parents = [node for node in nodes_in_tree if n_children[node] < 2]
         else:
             valid_parents = nodes_in_tree
-        connection_node = rng.choice(valid_parents, 1)[0]
+        connection_node = valid_parents[rng.integers(len(valid_parents))]
         # Integrate node
-        adj_matrix[connection_node, n] = 1
+        parents[n] = connection_node
+        n_children[connection_node] += 1
         nodes_in_tree.append(n)
         if connection_node == second_path_destination_node:
             second_path_destination_node = n
 
-    # Create networkx object
-    tree = nx.DiGraph(incoming_graph_data=adj_matrix)
-    return tree, source_node,destination_node, second_source,second_path_destination_node
+    return parents, source_node,destination_node, second_source,second_path_destination_node
+
+
+def sample_tree_graph_secondary_path(
+    n_states: int,
+    path_length: int,
+    rng: np.random.Generator,
+    is_binary: bool = True,
+    second_path_min_length: int = None,
+):
+    """Generate a random tree with the specified params
+
+    Args:
+        n_states (int): Number of nodes in tree
+        path_length (int): Length of path
+        rng (np.random.Generator): Random number generator
+        is_binary (bool, optional): Whether or not each node can have a 
+        max of two children. Defaults to False.
+
+    Returns:
+        Tuple[nx.DiGraph, int, int]: Return the graph, the root, and the goal node
+    """
+    parents, *nodes = sample_tree_parents_secondary_path(n_states, path_length, rng, is_binary, second_path_min_length)
+    return (parents_to_graph(parents), *nodes)
 
 
 def generate_example_secondary_path(
@@ -257,6 +571,7 @@ def generate_example_secondary_path(
     return_all_leafs: bool = False,
     is_binary: bool = True,
     second_path_min_length= None,
+    return_tokens: bool = False,
 ):
     """Generates a random example involving an edgelist of a tree, a leaf node, and a path from the root node to the leaf
     Args:
@@ -266,10 +581,12 @@ def generate_example_secondary_path(
         path_length (int, optional): Distance between root and goal in example. Defaults to None.
         return_all_leafs (bool, optional): Whether to return all possible path. Defaults to False.
         is_binary (bool, optional): Whether or not the tree should be binary. Defaults to False.
+        return_tokens (bool, optional): Whether to return token arrays instead of strings. Defaults to False.
 
     Returns:
         Returns single string by default
         Returns a list of all possible example strings if return_all_leafs is True
+        Returns token arrays in place of strings if return_tokens is True
     """
     assert n_states >= 2
     assert path_length is None or path_length < n_states
@@ -280,29 +597,18 @@ def generate_example_secondary_path(
         path_length = rng.integers(1, n_states)
     if second_path_min_length is None and path_length != 15:
         second_path_min_length = rng.integers(1, 15 - path_length + 1)
-    graph, start_node, goal,second_path_start,second_path_goal = sample_tree_graph_secondary_path(n_states, path_length, rng, is_binary,second_path_min_length)
-    edgelist = topological_sort_edges(graph)
+    parents, start_node, goal,second_path_start,second_path_goal = sample_tree_parents_secondary_path(n_states, path_length, rng, is_binary,second_path_min_length)
+    edgelist, leaf_paths = tree_edges_and_paths(parents, start_node)
     if order == "random":
         rng.shuffle(edgelist)
     elif order == "backward":
         edgelist = edgelist[::-1]
-    # Create all possible examples from edgelist
-    source_nodes = set([source for source, target in edgelist])
-    target_nodes = set([target for source, target in edgelist])
-    leaf_nodes = target_nodes - source_nodes
-    # Sample all possible paths
-    examples = {}
-    for end_node in list(leaf_nodes):
-        path = shortest_path(edgelist, n_states, start_node, end_node)
-        # Convert to a series of tokens
-        string = ",".join([f"{i}>{j}" for i, j in edgelist])
-        string = string + f"|{end_node}:"
-        string = string + ">".join([str(p) for p in path])
-        examples[end_node] = string
+    format_fn = partial(format_tokens, n_states=n_states) if return_tokens else format_examples
     # Return all leafs if specified
     if return_all_leafs:
-        return list(examples.values())
+        return list(format_fn(edgelist, leaf_paths, edgelist_leaf_nodes(edgelist)).values())
     elif return_second_goal and second_path_goal is not None:
-        return examples[goal], examples[second_path_goal] 
+        examples = format_fn(edgelist, leaf_paths, [goal, second_path_goal])
+        return examples[goal], examples[second_path_goal]
     else:
-        return examples[goal]
+        return format_fn(edgelist, leaf_paths, [goal])[goal]
@@ -1,155 +1,907 @@
+import itertools
 import os
+import random
 import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
 import networkx as nx
 import numpy as np
 import torch
-import wandb
+import torch.distributed as dist
+import torch.nn.functional as F
 from tqdm import tqdm
 
+from .loggers import get_logger
 
-def get_loaders(dataset, batch_size, train_test_split=0.9):
+
+def configure_cpu_threads(n_threads=None, n_interop_threads=None):
+    """Set the intra-op and inter-op thread pools of torch for CPU runs.
+
+    Args:
+        n_threads (int, optional): Intra-op threads. Defaults to the cores this process may run on,
+            shared evenly between the processes of a distributed run on this node.
+        n_interop_threads (int, optional): Inter-op threads. Defaults to 1, as eager training
+            runs one op at a time and extra pools only compete with the intra-op threads.
+    """
+    if n_threads is None:
+        # Respects taskset / cgroup CPU affinity on batch nodes, unlike os.cpu_count()
+        n_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        n_threads = max(1, n_threads // int(os.environ.get("LOCAL_WORLD_SIZE", 1)))
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_num_interop_threads(n_interop_threads or 1)
+    except RuntimeError:
+        # The inter-op pool can only be sized once, before any parallel work has started
+        pass
+
+
+def get_device(device=None):
+    """Resolve a device setting, falling back to CPU when CUDA is unavailable. Thread pools
+    are left alone, entry points size them once with configure_cpu_threads.
+
+    Args:
+        device (Union[str, torch.device], optional): "cuda", "cpu", "cuda:1", ... Defaults to
+            "cuda" if available.
+
+    Returns:
+        torch.device: The resolved device
+    """
+    if device is None:
+        # One GPU per process in distributed runs
+        device = f"cuda:{os.environ.get('LOCAL_RANK', 0)}" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def setup_distributed(backend=None):
+    """Join the process group set up by torchrun, if any. Uses gloo on CPU and nccl on GPU.
+
+    Returns:
+        Tuple[int, int]: Rank of this process and the number of processes
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not dist.is_initialized():
+        if backend is None:
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+        dist.init_process_group(backend)
+    return get_rank(), get_world_size()
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+@contextmanager
+def main_process_first():
+    # Let rank 0 create shared files, e.g. the dataset and its cache, before the other ranks read them
+    if get_rank() > 0:
+        dist.barrier()
+    yield
+    if get_rank() == 0 and get_world_size() > 1:
+        dist.barrier()
+
+
+PRECISIONS = ["fp32", "bf16"]
+
+
+def get_autocast(device, precision="fp32"):
+    """Context running the forward pass in the given precision. bf16 autocasts matmuls to
+    bfloat16 while the weights and the optimizer stay in fp32. bfloat16 has the exponent
+    range of fp32, so no loss scaling is needed.
+
+    Args:
+        device (Union[str, torch.device]): Device the model runs on
+        precision (str, optional): "fp32" or "bf16". Defaults to "fp32".
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, choose one of {PRECISIONS}")
+    if precision == "bf16":
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def get_model_device(model):
+    # Device the model's parameters live on
+    return next(model.parameters()).device
+
+
+def get_shared_generator(num_replicas, seed, epoch):
+    # Single process runs keep drawing from the global RNG, distributed ones need the same draws on every rank
+    if num_replicas == 1:
+        return None
+    return torch.Generator().manual_seed(seed + epoch)
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batches examples of similar length together. Indices are shuffled, split into
+    pools of 'bucket_size' batches, sorted by length within each pool and the resulting
+    batches are shuffled again.
+
+    With 'num_replicas' > 1 every rank draws the same batches from a generator seeded by
+    'seed' and the epoch, and takes every 'num_replicas'-th of them. All ranks get the same
+    number of batches."""
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, bucket_size=100, num_replicas=1, rank=0,
+                 seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = get_shared_generator(self.num_replicas, self.seed, self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).numpy()
+        else:
+            indices = np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batches += [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator)]
+        batches = batches[:len(self) * self.num_replicas][self.rank::self.num_replicas]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        pool_size = self.batch_size * self.bucket_size
+        pool_sizes = [min(pool_size, len(self.lengths) - start) for start in range(0, len(self.lengths), pool_size)]
+        if self.drop_last:
+            n_batches = sum(size // self.batch_size for size in pool_sizes)
+        else:
+            n_batches = sum((size + self.batch_size - 1) // self.batch_size for size in pool_sizes)
+        return n_batches // self.num_replicas
+
+
+class TensorBatchLoader:
+    """Yields batches by indexing the X and masks tensors of a GraphDataset directly
+    instead of collating single examples. The index permutation is drawn once per epoch.
+    Shuffled batches are split across 'num_replicas' ranks like in BucketBatchSampler."""
+
+    def __init__(self, dataset, indices, batch_size, shuffle=False, drop_last=False, batch_sampler=None, trim=False,
+                 num_replicas=1, rank=0, seed=0):
+        self.dataset = dataset
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        # Optional sampler yielding lists of positions into 'indices', e.g. a BucketBatchSampler
+        self.batch_sampler = batch_sampler
+        self.trim = trim
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if self.batch_sampler is not None and hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        if self.batch_sampler is not None:
+            batches = (self.indices[batch] for batch in self.batch_sampler)
+        else:
+            generator = get_shared_generator(self.num_replicas, self.seed, self.epoch)
+            order = self.indices[torch.randperm(len(self.indices), generator=generator)] if self.shuffle else self.indices
+            n_batches = len(self) * self.num_replicas
+            batches = order[:n_batches * self.batch_size].split(self.batch_size)[self.rank::self.num_replicas]
+        for batch in batches:
+            tokens, masks = self.dataset.X[batch], self.dataset.masks[batch]
+            if self.trim:
+                tokens, masks = trim_batch(tokens, masks, self.dataset.pad_token)
+            yield tokens, masks
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return len(self.indices) // self.batch_size // self.num_replicas
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size // self.num_replicas
+
+
+class RunningMetrics:
+    """Running means of per-batch metrics. The sums stay on the device, so updating them
+    does not wait for the host; only compute() synchronizes."""
+
+    def __init__(self, names, device, shape=()):
+        self.names = names
+        # 'shape' is that of a single metric value, e.g. (n_members,) for ensembles
+        self.totals = torch.zeros(len(names), *shape, device=device)
+        self.count = 0
+
+    def update(self, *values):
+        self.totals += torch.stack([value.detach().float() for value in values])
+        self.count += 1
+
+    def all_reduce(self):
+        # Sum the totals and batch counts of all ranks, so every rank computes the global means
+        if dist.is_initialized():
+            totals = torch.cat([self.totals.flatten(), torch.tensor([float(self.count)], device=self.totals.device)])
+            dist.all_reduce(totals)
+            self.totals, self.count = totals[:-1].view_as(self.totals), int(totals[-1].item())
+
+    def compute(self):
+        means = (self.totals / max(self.count, 1)).tolist()
+        return dict(zip(self.names, means))
+
+
+def get_loss_and_accuracy(logits, output_mask, targets, loss_fn):
+    """Loss and accuracy on the masked positions. Ensembles return logits for each member,
+    their loss is summed over the members, which keeps the members' gradients separate.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: Loss to backpropagate, and loss and
+            accuracy to report, per member for ensembles
+    """
+    if logits.dim() == 4:
+        outputs = logits[:, output_mask]
+        n_members = outputs.shape[0]
+        losses = F.cross_entropy(outputs.flatten(0, 1), targets.repeat(n_members), reduction="none")
+        losses = losses.view(n_members, -1).mean(-1)
+        accs = torch.mean((outputs.argmax(-1) == targets).to(torch.float), dim=-1) * 100
+        return losses.sum(), losses, accs
+    outputs = logits[output_mask]
+    loss = loss_fn(outputs, targets)
+    acc = torch.mean( (outputs.argmax(-1) == targets).to(torch.float)) * 100
+    return loss, loss, acc
+
+
+def get_masked_loss_and_accuracy(logits, targets, mask):
+    """Static shape version of get_loss_and_accuracy for compiled steps. All positions are
+    scored and weighted by the mask instead of gathering the masked ones."""
+    scores = F.cross_entropy(logits.flatten(0, -2), targets.expand(logits.shape[:-1]).flatten(), reduction="none")
+    # fp32 even under bf16 autocast, bf16 sums of the mask would miscount the targets
+    mask = mask.to(torch.float32)
+    n_targets = mask.sum()
+    # [n_members] for ensembles, scalars otherwise
+    losses = (scores.view(logits.shape[:-1]) * mask).sum((-2, -1)) / n_targets
+    accs = ((logits.argmax(-1) == targets) * mask).sum((-2, -1)) / n_targets * 100
+    return losses.sum(), losses, accs
+
+
+def get_path_accuracy(logits, targets, output_mask):
+    # Percentage of examples predicted correctly at every masked position, i.e. the whole
+    # path. Per member for ensembles.
+    correct = (logits.argmax(-1) == targets) | ~output_mask
+    return correct.all(-1).to(torch.float).mean(-1) * 100
+
+
+def compile_with_fallback(fn, **compile_kwargs):
+    # torch.compile 'fn', and run it eagerly from then on if compiling fails
+    compiled_fn = torch.compile(fn, **compile_kwargs)
+
+    def run(*args):
+        nonlocal compiled_fn
+        if compiled_fn is not None:
+            try:
+                return compiled_fn(*args)
+            except Exception as e:
+                warnings.warn(f"Compiling {fn.__name__} failed, falling back to eager mode: {e}")
+                compiled_fn = None
+        return fn(*args)
+    return run
+
+
+def get_train_step(model, optimizer, loss_fn, compile_step=False, precision="fp32"):
+    """Build the function running one optimization step on a batch.
+
+    Args:
+        model (torch.nn.Module): Model, or its DistributedDataParallel wrapper
+        optimizer (torch.optim.Optimizer): Optimizer over the model's parameters
+        loss_fn (Callable): Loss of the masked outputs
+        compile_step (bool, optional): Compile forward pass and loss, which needs batches of a
+            fixed shape. Falls back to eager mode if compiling fails. Defaults to False.
+        precision (str, optional): Precision of the forward pass, see get_autocast. Defaults to "fp32".
+
+    Returns:
+        Callable: step(tokens, mask) returning the loss and accuracy of the batch
+    """
+    def forward_loss(tokens, mask):
+        inputs = tokens[:, :-1]
+        output_mask = mask[:, 1:]
+        with get_autocast(tokens.device, precision):
+            if compile_step:
+                return get_masked_loss_and_accuracy(model(inputs), tokens[:, 1:], output_mask)
+            targets = tokens[:, 1:][output_mask]
+            return get_loss_and_accuracy(model(inputs), output_mask, targets, loss_fn)
+
+    if compile_step:
+        # The backward pass is compiled along with it
+        forward_loss = compile_with_fallback(forward_loss, dynamic=False)
+
+    def step(tokens, mask):
+        optimizer.zero_grad()
+        loss, loss_metric, acc = forward_loss(tokens, mask)
+        loss.backward()
+        # torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+        optimizer.step()
+        return loss_metric, acc
+    return step
+
+
+def get_log_metrics(prefix, metrics):
+    # Means over ensemble members, plus every member's own value
+    log_metrics = {f"{prefix}/{name}": float(np.mean(value)) for name, value in metrics.items()}
+    for name, value in metrics.items():
+        if isinstance(value, list):
+            log_metrics.update({f"member_{member}/{prefix}/{name}": v for member, v in enumerate(value)})
+    return log_metrics
+
+
+def select_member(metrics, member):
+    # Metrics of a single ensemble member, member None stands for a single model
+    if member is None:
+        return metrics
+    return {name: value[member] for name, value in metrics.items()}
+
+
+def to_cpu(obj):
+    # Copy every tensor in a (nested) state dict to the CPU, so training can keep updating the originals
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread and deletes the ones no longer needed.
+
+    A checkpoint is kept if it is among the last 'keep_last' ones, among the 'keep_best'
+    ones with the highest metric, or if its epoch is a multiple of 'keep_every'.
+    'on_saved(path, epoch, permanent)' is called on the writer thread after each write,
+    where 'permanent' marks checkpoints that are best so far or kept every N epochs.
+    """
+
+    def __init__(self, save_path, keep_last=3, keep_best=1, keep_every=None, on_saved=None, max_pending=2):
+        self.save_path = save_path
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_every = keep_every
+        self.on_saved = on_saved
+        self.max_pending = max_pending
+        self.metrics = {}  # epoch -> metric of the checkpoints on disk
+        self.best_metric = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def get_path(self, epoch):
+        return os.path.join(self.save_path, f"checkpoint_{epoch}.pt")
+
+    def save(self, epoch, state, metric=None):
+        # Snapshot now, write later
+        state = to_cpu(state)
+        self.wait(self.max_pending - 1)
+        self.pending.append(self.executor.submit(self.write, epoch, state, metric))
+
+    def write(self, epoch, state, metric):
+        path = self.get_path(epoch)
+        torch.save(state, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        is_best = metric is not None and (self.best_metric is None or metric > self.best_metric)
+        if is_best:
+            self.best_metric = metric
+        self.metrics[epoch] = metric
+        self.apply_retention()
+        if self.on_saved is not None:
+            permanent = is_best or (self.keep_every is not None and epoch % self.keep_every == 0)
+            self.on_saved(path, epoch, permanent)
+
+    def apply_retention(self):
+        epochs = sorted(self.metrics)
+        keep = set(epochs[-self.keep_last:]) if self.keep_last else set()
+        scored = [epoch for epoch in epochs if self.metrics[epoch] is not None]
+        keep |= set(sorted(scored, key=lambda epoch: self.metrics[epoch], reverse=True)[:self.keep_best])
+        if self.keep_every is not None:
+            keep |= {epoch for epoch in epochs if epoch % self.keep_every == 0}
+        for epoch in epochs:
+            if epoch not in keep:
+                del self.metrics[epoch]
+                os.remove(self.get_path(epoch))
+
+    def wait(self, max_pending=0):
+        # Block until at most 'max_pending' writes are in flight, raising errors from the writer thread
+        while len(self.pending) > max_pending:
+            self.pending.pop(0).result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def get_rng_state():
+    # State of every random number generator training draws from
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_checkpoint(checkpoint, device="cpu"):
+    # Checkpoints written by train hold RNG states besides tensors, hence weights_only=False
+    if not isinstance(checkpoint, dict):
+        checkpoint = torch.load(checkpoint, map_location=device, weights_only=False)
+    # Older runs saved their initialization as a bare state dict, which only holds weights
+    if "model" not in checkpoint:
+        return {"model": checkpoint}
+    # and pickled the scheduler itself instead of its state dict
+    if "scheduler" in checkpoint and not isinstance(checkpoint["scheduler"], dict):
+        checkpoint = {**checkpoint, "scheduler": checkpoint["scheduler"].state_dict()}
+    return checkpoint
+
+
+def trim_batch(tokens, masks, pad_token):
+    # Trim the batch after the first padding token of its longest example, which is the
+    # last target evaluation looks at. The masks are unchanged up to that point.
+    n_tokens = (tokens != pad_token).cumsum(dim=1).argmax(dim=1).max().item() + 2
+    n_tokens = min(n_tokens, tokens.shape[1])
+    return tokens[:, :n_tokens], masks[:, :n_tokens]
+
+
+def set_loader_epoch(loader, epoch):
+    # Reseed the shuffling of distributed samplers and draw fresh examples from streaming datasets
+    for obj in [loader, getattr(loader, "batch_sampler", None), getattr(loader, "sampler", None),
+                getattr(loader, "dataset", None)]:
+        if obj is not None and hasattr(obj, "set_epoch"):
+            obj.set_epoch(epoch)
+
+
+def get_split_indices(dataset, train_test_split=0.9):
+    """Split a GraphDataset by the hash of each tree's edge set, so the same tree never
+    ends up on both sides. The split is deterministic and saved next to the dataset cache.
+
+    Args:
+        dataset (GraphDataset): Dataset with a 'tree_hash' metadata column
+        train_test_split (float, optional): Expected fraction of training examples. Defaults to 0.9.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Indices of the train and test examples
+    """
+    split_file = os.path.join(dataset.cache_dir, f"split_{dataset.cache_key}_{train_test_split}.npz")
+    if os.path.exists(split_file):
+        with np.load(split_file) as f:
+            return f["train"], f["test"]
+    # Map the hash to [0, 1) and threshold it
+    position = (dataset.metadata["tree_hash"] >> np.uint64(11)).astype(np.float64) / 2**53
+    is_train = position < train_test_split
+    train_indices, test_indices = np.flatnonzero(is_train), np.flatnonzero(~is_train)
+    os.makedirs(dataset.cache_dir, exist_ok=True)
+    with open(split_file + ".tmp", "wb") as f:
+        np.savez(f, train=train_indices, test=test_indices)
+    os.replace(split_file + ".tmp", split_file)
+    return train_indices, test_indices
+
+
+def get_loaders(dataset, batch_size, train_test_split=0.9, dynamic_padding=False, tensor_batches=False, split="tree",
+                seed=0):
+    # In distributed runs every rank gets its own share of both sets
+    rank, world_size = get_rank(), get_world_size()
     # Split the dataset into train and test sets
-    train_size = int(train_test_split * len(dataset))
-    test_size = len(dataset) - train_size
-    train_dataset, test_dataset = torch.utils.data.random_split(dataset,
-                                                    [train_size, test_size])
-    # Collate function
+    if split == "tree":
+        train_indices, test_indices = get_split_indices(dataset, train_test_split)
+    else:
+        train_size = int(train_test_split * len(dataset))
+        test_size = len(dataset) - train_size
+        # All ranks have to agree on the split
+        generator = torch.Generator().manual_seed(seed) if world_size > 1 else None
+        train_dataset, test_dataset = torch.utils.data.random_split(dataset,
+                                                        [train_size, test_size], generator=generator)
+        train_indices, test_indices = np.asarray(train_dataset.indices), np.asarray(test_dataset.indices)
+    # Evaluation needs no synchronization, so the test set is simply sharded
+    test_indices = test_indices[rank::world_size]
+    train_dataset = torch.utils.data.Subset(dataset, train_indices)
+    test_dataset = torch.utils.data.Subset(dataset, test_indices)
+    # Batch samplers grouping examples of similar length. Trimming drops the masked targets
+    # predicting padding after padding, so only training batches are trimmed and evaluation
+    # keeps the exact masked loss and accuracy.
+    train_sampler = None
+    if dynamic_padding:
+        # Tokens up to the end of the path, see GraphDataset.load_metadata
+        lengths = dataset.metadata["prompt_length"].astype(np.int64) + dataset.metadata["path_length"]
+        train_sampler = BucketBatchSampler(lengths[train_dataset.indices], batch_size, shuffle=True, drop_last=True,
+                                           num_replicas=world_size, rank=rank, seed=seed)
+    # Index the stacked tensors directly
+    if tensor_batches:
+        train_loader = TensorBatchLoader(dataset, train_dataset.indices, batch_size, shuffle=True, drop_last=True,
+                                         batch_sampler=train_sampler, trim=dynamic_padding,
+                                         num_replicas=world_size, rank=rank, seed=seed)
+        test_loader = TensorBatchLoader(dataset, test_dataset.indices, batch_size, shuffle=False, drop_last=False)
+        return train_loader, test_loader
+    # Collate functions
     def collate(data):
         tokens, masks = zip(*data)
         tokens = torch.stack(tokens, dim=0)
         masks = torch.stack(masks, dim=0)
         return tokens, masks
+
+    def trimmed_collate(data):
+        return trim_batch(*collate(data), dataset.pad_token)
     # Create data loaders for train and test sets
-    train_loader = torch.utils.data.DataLoader(train_dataset,
-                                               batch_size=batch_size,
-                                               shuffle=True,
-                                               drop_last=True,
-                                               collate_fn=collate)
     test_loader = torch.utils.data.DataLoader(test_dataset,
                                               batch_size=batch_size,
                                               shuffle=False,
                                               collate_fn=collate)
+    if dynamic_padding:
+        train_loader = torch.utils.data.DataLoader(train_dataset,
+                                                   batch_sampler=train_sampler,
+                                                   collate_fn=trimmed_collate)
+        # Marks the trimmed batches like TensorBatchLoader.trim, see train
+        train_loader.trim = True
+        return train_loader, test_loader
+    if world_size > 1:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=world_size,
+                                                                        rank=rank, shuffle=True, seed=seed,
+                                                                        drop_last=True)
+    train_loader = torch.utils.data.DataLoader(train_dataset,
+                                               batch_size=batch_size,
+                                               shuffle=train_sampler is None,
+                                               sampler=train_sampler,
+                                               drop_last=True,
+                                               collate_fn=collate)
     return train_loader, test_loader
 
 
-def train(model, train_loader, test_loader, n_epochs, learning_rate=3e-4, betas=(0.9, 0.99), wd=0.01, use_wandb=True):
+def get_stratified_sample(strata, n_examples, seed=0):
+    """Draw about 'n_examples' positions without replacement, the same share from every
+    stratum but at least one from each, so rare strata such as the longest paths are
+    always represented.
+
+    Args:
+        strata (np.ndarray): Stratum of every entry, e.g. its path length
+        n_examples (int): Size of the sample
+        seed (int, optional): Seed of the draw. Defaults to 0.
+
+    Returns:
+        np.ndarray: Sorted positions into 'strata'
+    """
+    strata = np.asarray(strata)
+    if n_examples >= len(strata):
+        return np.arange(len(strata))
+    rng = np.random.default_rng(seed)
+    positions = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        quota = min(max(round(len(members) * n_examples / len(strata)), 1), len(members))
+        positions.append(rng.choice(members, quota, replace=False))
+    return np.sort(np.concatenate(positions))
+
+
+def get_subsample_loader(test_loader, n_examples, seed=0):
+    """Loader over a fixed subsample of a test loader from get_loaders, stratified by path
+    length. The subsample is the same in every call, so evaluations on it stay comparable.
+
+    Args:
+        test_loader (Union[torch.utils.data.DataLoader, TensorBatchLoader]): Test loader
+        n_examples (int): Number of examples
+        seed (int, optional): Seed of the subsample. Defaults to 0.
+
+    Returns:
+        Union[torch.utils.data.DataLoader, TensorBatchLoader]: Loader of the same kind
+    """
+    if isinstance(test_loader, TensorBatchLoader):
+        dataset, indices = test_loader.dataset, test_loader.indices.numpy()
+    elif isinstance(test_loader.dataset, torch.utils.data.Subset):
+        dataset, indices = test_loader.dataset.dataset, np.asarray(test_loader.dataset.indices)
+    else:
+        # e.g. a StreamingGraphDataset, which has no metadata to stratify by
+        raise ValueError("Subsampled evaluation needs a test loader from get_loaders, evaluate streamed "
+                         "test sets in full by using a finite test stream without eval_subsample")
+    positions = get_stratified_sample(dataset.metadata["path_length"][indices], n_examples, seed)
+    if isinstance(test_loader, TensorBatchLoader):
+        return TensorBatchLoader(dataset, indices[positions], test_loader.batch_size, trim=test_loader.trim)
+    subset = torch.utils.data.Subset(dataset, indices[positions])
+    return torch.utils.data.DataLoader(subset, batch_size=test_loader.batch_size, shuffle=False,
+                                       collate_fn=test_loader.collate_fn)
+
+
+def evaluate(model, test_loader, device, metric_shape=(), precision="fp32", log_interval=50, description="TEST ",
+             show_progress=True):
+    """Loss and accuracy on the masked positions and exact path accuracy of a model. In
+    distributed runs the metrics are averaged over the shards of all ranks.
+
+    Args:
+        model (torch.nn.Module): Model, an ensemble's metrics are per member
+        test_loader (Iterable): Batches of tokens and masks
+        device (torch.device): Device of the model
+        metric_shape (tuple, optional): Shape of a metric value, (n_members,) for ensembles. Defaults to ().
+        precision (str, optional): Precision of the forward pass, see get_autocast. Defaults to "fp32".
+        log_interval (int, optional): Batches between progress bar updates. Defaults to 50.
+        description (str, optional): Progress bar prefix. Defaults to "TEST ".
+        show_progress (bool, optional): Show a progress bar. Defaults to True.
+
+    Returns:
+        Dict[str, Union[float, List[float]]]: Mean loss, acc and path_acc
+    """
+    model.eval()
+    loss_fn = torch.nn.CrossEntropyLoss()
+    with torch.no_grad():
+
+        pbar = tqdm(total=len(test_loader), disable=not show_progress)
+        metrics = RunningMetrics(["loss", "acc", "path_acc"], device, metric_shape)
+
+        for idx, (tokens, mask) in enumerate(test_loader):
+
+            tokens = tokens.to(device, non_blocking=True).to(torch.long)
+            inputs = tokens[:, :-1]
+            output_mask = mask[:, 1:].to(device, non_blocking=True)
+            targets = tokens[:, 1:][output_mask]
+
+            with get_autocast(device, precision):
+                logits = model(inputs)
+                _, loss_metric, acc = get_loss_and_accuracy(logits, output_mask, targets, loss_fn)
+            metrics.update(loss_metric, acc, get_path_accuracy(logits, tokens[:, 1:], output_mask))
+
+            if (idx + 1) % log_interval == 0 or idx + 1 == len(test_loader):
+                test_metrics = get_log_metrics("test", metrics.compute())
+                pbar.set_description(f"{description} - Loss: {test_metrics['test/loss']:.4f}, Acc: {test_metrics['test/acc']:.4f}%, Path acc: {test_metrics['test/path_acc']:.4f}%")
+            pbar.update(1)
+
+        pbar.close()
+        metrics.all_reduce()
+        return metrics.compute()
+
+
+def train(model, train_loader, test_loader, n_epochs, learning_rate=3e-4, betas=(0.9, 0.99), wd=0.01, use_wandb=True,
+          device=None, log_interval=50, keep_last=3, keep_best=1, keep_every=100, checkpoint=None,
+          log_backend="jsonl", compile_step=False, precision="fp32", eval_every=1, eval_every_steps=None,
+          full_eval_every=10, eval_subsample=None, target_path_acc=None, steps_per_epoch=None):
+    # Evaluation schedule: after every 'eval_every' epochs and every 'eval_every_steps' steps,
+    # on a fixed stratified subsample of 'eval_subsample' test examples if given. The full test
+    # set is evaluated every 'full_eval_every' epochs and after the last one. Training stops
+    # once the exact path accuracy (percent) on the full test set reaches 'target_path_acc'.
+    # Loaders without a length, e.g. over an unlimited StreamingGraphDataset, need 'steps_per_epoch'
+    if steps_per_epoch is None:
+        try:
+            steps_per_epoch = len(train_loader)
+        except TypeError:
+            raise ValueError("train_loader has no length, pass steps_per_epoch") from None
+    # Train on the model's device unless told otherwise
+    device = get_device(get_model_device(model) if device is None else device)
+    model.to(device)
+    # Data parallel training if launched with torchrun, only rank 0 logs and checkpoints
+    rank, world_size = get_rank(), get_world_size()
+    is_main = rank == 0
+    # Ensembles train several models at once, each with its own checkpoints and metrics
+    n_members = getattr(model, "n_members", None)
+    members = [None] if n_members is None else list(range(n_members))
+    metric_shape = () if n_members is None else (n_members,)
     optimizer = torch.optim.AdamW(model.parameters(), learning_rate, betas=betas, weight_decay=wd)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, n_epochs, 2e-6)
     loss_fn = torch.nn.CrossEntropyLoss()
 
-    current_time = int(time.time())
-    save_path = f"./outputs/run_{current_time}"
-    os.makedirs(save_path, exist_ok=True)
-    
-    if use_wandb:
+    # Continue from a checkpoint written by a previous run
+    start_epoch = 0
+    if checkpoint is not None and n_members is not None:
+        # One checkpoint per member, all from the same epoch
+        checkpoints = [load_checkpoint(member_checkpoint, device) for member_checkpoint in checkpoint]
+        model.load_member_state_dicts([member_checkpoint["model"] for member_checkpoint in checkpoints])
+        if all("optimizer" in member_checkpoint for member_checkpoint in checkpoints):
+            optimizer.load_state_dict(model.stack_optimizer_state_dicts(
+                [member_checkpoint["optimizer"] for member_checkpoint in checkpoints]))
+        checkpoint = checkpoints[0]
+    elif checkpoint is not None:
+        checkpoint = load_checkpoint(checkpoint, device)
+        model.load_state_dict(checkpoint["model"])
+        if "optimizer" in checkpoint:
+            optimizer.load_state_dict(checkpoint["optimizer"])
+    if checkpoint is not None and "epoch" in checkpoint:
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        if "rng" in checkpoint:
+            set_rng_state(checkpoint["rng"])
+        start_epoch = checkpoint["epoch"] + 1
+        if is_main:
+            print(f"Resuming from epoch {start_epoch}")
+    elif checkpoint is not None and is_main:
+        # Weights only, e.g. an initialization, training starts at epoch 0
+        print("Starting from the checkpoint's weights at epoch 0")
+
+    # Gradients are averaged across ranks in backward(), rank 0's initial weights are broadcast
+    forward_model = model
+    if world_size > 1:
+        device_ids = [device.index] if device.type == "cuda" else None
+        forward_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+
+    # Without dynamic padding all training batches have the same shape, as a compiled step needs
+    train_step = get_train_step(forward_model, optimizer, loss_fn, compile_step=compile_step, precision=precision)
+
+    # Trimmed batches leave out the targets predicting padding after padding, so their metrics
+    # are logged as train_trimmed/... and never compared with untrimmed ones
+    train_prefix = "train_trimmed" if getattr(train_loader, "trim", False) else "train"
+
+    # Every rank subsamples its own shard of the test set
+    subsample_loader = None
+    if eval_subsample is not None:
+        subsample_loader = get_subsample_loader(test_loader, eval_subsample // world_size)
+
+    if is_main:
+        current_time = int(time.time())
+        save_path = f"./outputs/run_{current_time}"
+        # Ensemble members are saved to their own subdirectories
+        member_paths = [save_path if member is None else os.path.join(save_path, f"member_{member}")
+                        for member in members]
+        checkpoint_writers = []
+        for member_path in member_paths:
+            os.makedirs(member_path, exist_ok=True)
+            checkpoint_writers.append(CheckpointWriter(member_path, keep_last=keep_last, keep_best=keep_best,
+                                                       keep_every=keep_every))
+
+        def get_member_state(member):
+            return model.state_dict() if member is None else model.member_state_dict(member)
+
+        # Metrics go to a local log under save_path and optionally to wandb, from a background thread
         run_name = f"CoT_Ext_{current_time}"
         opt_kwargs = {
             "lr": learning_rate,
             "n_epochs": n_epochs,
-            "betas": betas
+            "betas": betas,
+            "world_size": world_size,
+            "precision": precision,
+            "seeds": getattr(model, "seeds", None)
         }
-        wandb.init(
-            project="planning-in-transformers",
-            name=run_name,
-            config=({
-                **model.cfg.__dict__, **opt_kwargs
-            })
-        )
-
-        # save initialization
-        torch.save(model.state_dict(), f"./{save_path}/checkpoint_0.pt")
-        artifact = wandb.Artifact(run_name, type="model")
-        artifact.add_file(local_path=f"./{save_path}/checkpoint_0.pt",
-                        name=f"checkpoint_0.pt")
-        wandb.log_artifact(artifact)
-
-    # Start training
-    for epoch in range(n_epochs):
-
-        pbar = tqdm(total=len(train_loader))
-        model.train()
-        losses = []
-        accs = []
-
-        for idx, (tokens, mask) in enumerate(train_loader):
-            optimizer.zero_grad()
-            
-            tokens = tokens.cuda().to(torch.long)
-            inputs = tokens[:, :-1]
-            output_mask = mask[:, 1:].cuda()
-            targets = tokens[:, 1:][output_mask]
-            
-            outputs = model(inputs)[output_mask]
-            loss = loss_fn(outputs, targets)
-            
-            loss.backward()
-            # torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
-            optimizer.step()
-            
-            losses.append(loss.item())
-            acc = torch.mean( (outputs.argmax(-1) == targets).to(torch.float)) * 100
-            accs.append(acc)
-
-            pbar.set_description(f"TRAIN - Epoch: {epoch+1}, Loss: {sum(losses)/len(losses):.4f}, Acc: {sum(accs)/len(accs):.4f}%")
-            pbar.update(1)
+        logger = get_logger(save_path, backend=log_backend, use_wandb=use_wandb, project="planning-in-transformers",
+                            name=run_name, config={**model.cfg.__dict__, **opt_kwargs})
 
-        scheduler.step()
-        pbar.close()
-        
-        if use_wandb:        
-            wandb.log({"train/loss": sum(losses) / len(losses)}, step=epoch)
-            wandb.log({"train/acc": sum(accs)/len(accs)}, step=epoch)
-    
-        model.eval()
-        with torch.no_grad():
-
-            pbar = tqdm(total=len(test_loader))
-            losses = []
-            accs = []
-
-            for idx, (tokens, mask) in enumerate(test_loader):
-
-                tokens = tokens.cuda().to(torch.long)
-                inputs = tokens[:, :-1]
-                output_mask = mask[:, 1:].cuda()
-                targets = tokens[:, 1:][output_mask]
-                
-                outputs = model(inputs)[output_mask]
-                loss = loss_fn(outputs, targets)
-                
-                losses.append(loss.item())
-                acc = torch.mean( (outputs.argmax(-1) == targets).to(torch.float)) * 100
-                accs.append(acc)
-                
-                pbar.set_description(f"TEST  - Epoch: {epoch+1}, Loss: {sum(losses)/len(losses):.4f}, Acc: {sum(accs)/len(accs):.4f}%")
+        for member, member_path, checkpoint_writer in zip(members, member_paths, checkpoint_writers):
+            prefix = "" if member is None else f"member_{member}/"
+            # save initialization
+            init_path = os.path.join(member_path, "checkpoint_init.pt")
+            torch.save(get_member_state(member), init_path)
+            logger.log_artifact(init_path, f"{prefix}checkpoint_init.pt")
+
+            # Only upload checkpoints that retention keeps for good
+            def log_checkpoint(path, epoch, permanent, prefix=prefix):
+                if permanent:
+                    logger.log_artifact(path, f"{prefix}checkpoint_{epoch}.pt")
+            checkpoint_writer.on_saved = log_checkpoint
+
+    def run_evaluation(full, epoch, global_step):
+        # Metrics of the full test set are logged as test/..., those of the subsample as test_subsample/...
+        loader, prefix = (test_loader, "test") if full or subsample_loader is None else (subsample_loader, "test_subsample")
+        start = time.perf_counter()
+        eval_metrics = evaluate(model, loader, device, metric_shape, precision, log_interval,
+                                f"{prefix.upper()} - Epoch: {epoch+1}", is_main)
+        if is_main:
+            logger.log({**get_log_metrics(prefix, eval_metrics), f"{prefix}/time": time.perf_counter() - start,
+                        "epoch": epoch}, step=global_step)
+        return prefix, eval_metrics
+
+    def reached_target(eval_metrics):
+        # Every ensemble member has to reach the target
+        return target_path_acc is not None and np.min(eval_metrics["path_acc"]) >= target_path_acc
+
+    # Start training, metrics are logged against the number of optimizer steps
+    try:
+        for epoch in range(start_epoch, n_epochs):
+
+            is_milestone = epoch + 1 == n_epochs or (full_eval_every is not None and (epoch + 1) % full_eval_every == 0)
+            evaluate_epoch = is_milestone or (eval_every is not None and (epoch + 1) % eval_every == 0)
+
+            set_loader_epoch(train_loader, epoch)
+            pbar = tqdm(total=steps_per_epoch, disable=not is_main)
+            model.train()
+            metrics = RunningMetrics(["loss", "acc"], device, metric_shape)
+
+            for idx, (tokens, mask) in enumerate(itertools.islice(train_loader, steps_per_epoch)):
+                tokens = tokens.to(device, non_blocking=True).to(torch.long)
+                mask = mask.to(device, non_blocking=True)
+                loss_metric, acc = train_step(tokens, mask)
+                metrics.update(loss_metric, acc)
+
+                # Reading the metrics synchronizes with the device, so only do it every few steps.
+                # The progress bar shows rank 0's share of the batches.
+                if (idx + 1) % log_interval == 0 or idx + 1 == steps_per_epoch:
+                    train_metrics = metrics.compute()
+                    pbar.set_description(f"TRAIN - Epoch: {epoch+1}, Loss: {np.mean(train_metrics['loss']):.4f}, Acc: {np.mean(train_metrics['acc']):.4f}%")
                 pbar.update(1)
-        
+
+                global_step = epoch * steps_per_epoch + idx + 1
+                # The evaluation after the epoch takes the place of one on its last step
+                skip_step_eval = evaluate_epoch and idx + 1 == steps_per_epoch
+                if eval_every_steps is not None and global_step % eval_every_steps == 0 and not skip_step_eval:
+                    run_evaluation(False, epoch, global_step)
+                    model.train()
+
+            scheduler.step()
             pbar.close()
-        
-        if use_wandb:
-            checkpoint = { 
-                'epoch': epoch,
-                'model': model.state_dict(),
-                'optimizer': optimizer.state_dict(),
-                'scheduler': scheduler
-            }
-            torch.save(checkpoint, f"./{save_path}/checkpoint_{epoch}.pt")
-            wandb.log({"test/loss": sum(losses)/len(losses)}, step=epoch)
-            wandb.log({"test/acc": sum(accs)/len(accs)}, step=epoch)
-            
-            # Save model
-            artifact = wandb.Artifact(run_name, type="model")
-            artifact.add_file(local_path=f"./{save_path}/checkpoint_{epoch}.pt",
-                            name=f"checkpoint_{epoch}.pt")
-            wandb.log_artifact(artifact)
-
-
-def get_example_cache(example, model, dataset):
+            metrics.all_reduce()
+            train_metrics = metrics.compute()
+            # A single non-finite step makes the epoch's mean loss non-finite, checked without extra syncs
+            if not np.all(np.isfinite(train_metrics["loss"])):
+                raise FloatingPointError(f"Non-finite training loss in epoch {epoch} with precision {precision}")
+
+            global_step = (epoch + 1) * steps_per_epoch
+            if is_main:
+                logger.log({**get_log_metrics(train_prefix, train_metrics), "epoch": epoch}, step=global_step)
+
+            # Metrics of this epoch's evaluations by prefix, all ranks take the same decisions from them
+            epoch_metrics = {}
+            if evaluate_epoch:
+                prefix, eval_metrics = run_evaluation(is_milestone, epoch, global_step)
+                epoch_metrics[prefix] = eval_metrics
+                # Confirm on the full test set before stopping
+                if prefix != "test" and reached_target(eval_metrics):
+                    prefix, eval_metrics = run_evaluation(True, epoch, global_step)
+                    epoch_metrics[prefix] = eval_metrics
+            # Stopping and the ranking of checkpoints only go by full evaluations
+            test_metrics = epoch_metrics.get("test")
+            stop = test_metrics is not None and reached_target(test_metrics)
+
+            if is_main:
+                optimizer_state = optimizer.state_dict()
+                for member, checkpoint_writer in zip(members, checkpoint_writers):
+                    # Per member metrics and optimizer state for ensembles
+                    checkpoint = {
+                        'epoch': epoch,
+                        'model': get_member_state(member),
+                        'optimizer': optimizer_state if member is None else
+                                     model.member_optimizer_state_dict(optimizer_state, member),
+                        'scheduler': scheduler.state_dict(),
+                        'metrics': {train_prefix: select_member(train_metrics, member),
+                                    **{prefix: select_member(eval_metrics, member)
+                                       for prefix, eval_metrics in epoch_metrics.items()}},
+                        'rng': get_rng_state()
+                    }
+                    metric = None if test_metrics is None else select_member(test_metrics, member)["acc"]
+                    checkpoint_writer.save(epoch, checkpoint, metric=metric)
+
+            if stop:
+                if is_main:
+                    print(f"Reached {target_path_acc}% path accuracy on the test set, stopping after epoch {epoch+1}")
+                break
+    finally:
+        # Also on errors, e.g. a non-finite loss or an interrupt, so queued writes and log records
+        # are flushed and the wandb run is finished
+        if is_main:
+            for checkpoint_writer in checkpoint_writers:
+                checkpoint_writer.close()
+            logger.close()
+
+
+def get_example_cache(example, model, dataset, precision="fp32"):
     # Output tokens and forward cache
     tokens = dataset.tokenize(example)[:-1]
-    inputs = torch.from_numpy(tokens).unsqueeze(0).cuda()
-    _, cache = model.run_with_cache(inputs)
+    device = get_model_device(model)
+    inputs = torch.from_numpy(tokens).unsqueeze(0).to(device)
+    with get_autocast(device, precision):
+        _, cache = model.run_with_cache(inputs)
     labels = [dataset.idx2tokens[idx] for idx in tokens]
     return labels, cache
 
@@ -224,9 +976,10 @@ def num_last(arr, char):
     return fidx + 1
 
 
-def eval_model(model, dataset, test_graph):
+def eval_model(model, dataset, test_graph, precision="fp32"):
     # Prepare model
     model.eval()
+    device = get_model_device(model)
     
     # Initialize counters
     test_graph_tokens = dataset.tokenize(test_graph)
@@ -236,11 +989,11 @@ def eval_model(model, dataset, test_graph):
     flag = False
     while not flag and curr_idx < dataset.max_seq_length - 1:
         # Convert to pytorch
-        input_tokens = torch.from_numpy(test_graph_tokens).to(torch.long).cuda()
+        input_tokens = torch.from_numpy(test_graph_tokens).to(torch.long).to(device)
         input_tokens[curr_idx:] = 0
         input_tokens = input_tokens.unsqueeze(0)[:, :-1]
         # Run model
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(device, precision):
             outputs = model(input_tokens).argmax(-1)
             pred = outputs[0, curr_idx-1]
             test_graph_tokens[curr_idx] = pred.item()
@@ -252,20 +1005,21 @@ def eval_model(model, dataset, test_graph):
     return final_path, test_graph == final_path
 
 
-def is_model_correct(model, dataset, test_graph, return_probs=False):
+def is_model_correct(model, dataset, test_graph, return_probs=False, precision="fp32"):
     # Prepare model
     model.eval()
+    device = get_model_device(model)
 
     # Initialize counters
     test_graph_tokens = dataset.tokenize(test_graph)
     start_idx = np.where(test_graph_tokens == dataset.start_token)[0].item() + 1
     end_idx = num_last([dataset.idx2tokens[i] for i in test_graph_tokens], ",")
-    input_tokens = torch.from_numpy(test_graph_tokens).to(torch.long).cuda()
+    input_tokens = torch.from_numpy(test_graph_tokens).to(torch.long).to(device)
     input_tokens = input_tokens.unsqueeze(0)[:, :-1]
 
     # Run model
-    with torch.no_grad():
-        probs = model(input_tokens).softmax(-1)
+    with torch.no_grad(), get_autocast(device, precision):
+        probs = model(input_tokens).float().softmax(-1)
         outputs = probs.argmax(-1)
     correct = torch.all(outputs[:, start_idx:end_idx] == input_tokens[:, start_idx+1:end_idx+1]).item()
     if return_probs:
@@ -273,9 +1027,10 @@ def is_model_correct(model, dataset, test_graph, return_probs=False):
     return correct
 
 
-def is_model_correct_multiple(model, dataset, multiple_test_graph, return_probs=False):
+def is_model_correct_multiple(model, dataset, multiple_test_graph, return_probs=False, precision="fp32"):
     # Prepare model
     model.eval()
+    device = get_model_device(model)
 
     # Initialize counters
     multiple_input_tokens = []
@@ -286,7 +1041,7 @@ def is_model_correct_multiple(model, dataset, multiple_test_graph, return_probs=
         test_graph_tokens = dataset.tokenize(test_graph)
         start_idx = np.where(test_graph_tokens == dataset.start_token)[0].item() + 1
         end_idx = num_last([dataset.idx2tokens[i] for i in test_graph_tokens], ",")
-        input_tokens = torch.from_numpy(test_graph_tokens).to(torch.long).cuda()
+        input_tokens = torch.from_numpy(test_graph_tokens).to(torch.long).to(device)
         input_tokens = input_tokens.unsqueeze(0)[:, :-1]
         multiple_input_tokens.append(input_tokens)
         multiple_start_idx.append(start_idx)
@@ -295,8 +1050,8 @@ def is_model_correct_multiple(model, dataset, multiple_test_graph, return_probs=
     multiple_input_tokens = torch.cat(multiple_input_tokens, dim=0)
     
     # Run model
-    with torch.no_grad():
-        probs = model(multiple_input_tokens).softmax(-1)
+    with torch.no_grad(), get_autocast(device, precision):
+        probs = model(multiple_input_tokens).float().softmax(-1)
         outputs = probs.argmax(-1)
         
     correct = 0
@@ -0,0 +1,122 @@
+import hashlib
+import json
+
+import numpy as np
+import pytest
+
+from graphcot.tree_generation.dataset import GraphTokenizer, generate_dataset_file, generate_dataset_line
+from graphcot.tree_generation.gen import generate_example, generate_example_secondary_path
+
+ORDERS = ["forward", "backward", "random"]
+# The secondary path generator bounds the path length at 15 nodes
+SECONDARY_PATH_MAX_STATES = 16
+
+
+def startswith_tokenize(tokenizer, text):
+    # The original tokenizer, which scans the vocab in order at every position
+    tokens = []
+    i = 0
+    while i < len(text):
+        for idx, word in enumerate(tokenizer.idx2tokens):
+            if text.startswith(word, i):
+                tokens.append(idx)
+                i += len(word)
+                break
+        else:
+            i += 1
+    tokens_arr = np.array(tokens)
+    padding_length = tokenizer.max_seq_length - len(tokens)
+    return np.pad(tokens_arr, ((0, padding_length),), mode='constant', constant_values=0)
+
+
+def examples_checksum(fn, n_seeds=300, **kwargs):
+    hasher = hashlib.sha256()
+    for seed in range(n_seeds):
+        for order in ORDERS:
+            hasher.update((repr(fn(16, seed, order=order, **kwargs)) + "\n").encode())
+    return hasher.hexdigest()
+
+
+@pytest.mark.parametrize("n_states", [8, 16, 30])
+def test_tokenize_matches_startswith_scan(n_states):
+    tokenizer = GraphTokenizer(n_states)
+    texts = [generate_example(n_states, seed, order=order) for seed in range(50) for order in ORDERS]
+    if n_states <= SECONDARY_PATH_MAX_STATES:
+        texts += [generate_dataset_line(n_states, seed) for seed in range(100)]
+    expected = np.stack([startswith_tokenize(tokenizer, text) for text in texts])
+    assert np.array_equal(np.stack([tokenizer.tokenize(text) for text in texts]), expected)
+    assert np.array_equal(tokenizer.tokenize_batch(texts), expected)
+
+
+@pytest.mark.parametrize("n_states", [8, 16, 30])
+def test_generated_tokens_match_tokenized_strings(n_states):
+    tokenizer = GraphTokenizer(n_states)
+    for seed in range(20):
+        for order in ORDERS:
+            tokens = generate_example(n_states, seed, order=order, return_tokens=True)
+            assert np.array_equal(tokens, tokenizer.tokenize(generate_example(n_states, seed, order=order)))
+            if n_states > SECONDARY_PATH_MAX_STATES:
+                continue
+            tokens = generate_example_secondary_path(n_states, seed, order=order, return_tokens=True)
+            assert np.array_equal(tokens, tokenizer.tokenize(generate_example_secondary_path(n_states, seed, order=order)))
+        if n_states > SECONDARY_PATH_MAX_STATES:
+            continue
+        tokens = generate_dataset_line(n_states, seed, return_tokens=True)
+        assert np.array_equal(tokens, tokenizer.tokenize(generate_dataset_line(n_states, seed)))
+
+
+def test_generated_strings_are_unchanged():
+    # Checksums of the examples produced by the original generators
+    assert examples_checksum(generate_example) == "7f960b4ad489e1e69f3642417f99a66e64e0722dfe25089d6861edadc520f3e9"
+    assert examples_checksum(generate_example, return_all_leafs=True) == "cbb3849ee65ec082a2a6bc9550df5ab074a06ab09a4cd744d2a59b2f5105428c"
+    assert examples_checksum(generate_example_secondary_path) == "431730b95dd2a97d3f535e43fc68d6927e73a8be245e3a4eed88f6cd72038d0b"
+    assert examples_checksum(
+        generate_example_secondary_path, return_second_goal=True, return_all_leafs=True
+    ) == "01a9475ace8bc29674e30bc0b8aef295cda1fa5e9457df86cb76eb69789f75f2"
+
+
+def test_parallel_dataset_file_matches_serial(tmp_path):
+    serial_file = str(tmp_path / "serial.txt")
+    parallel_file = str(tmp_path / "parallel.txt")
+    generate_dataset_file(16, serial_file, 200, start_seed=5)
+    generate_dataset_file(16, parallel_file, 200, start_seed=5, n_workers=3)
+    with open(serial_file, "rb") as f:
+        serial = f.read()
+    with open(parallel_file, "rb") as f:
+        assert f.read() == serial
+    with open(f"{parallel_file}.manifest.json", "r") as f:
+        manifest = json.load(f)
+    assert manifest["next_seed"] == 205
+    assert manifest["checksum"] == hashlib.sha256(serial).hexdigest()
+    assert not list(tmp_path.glob("*.shard*"))
+
+
+def test_interrupted_dataset_file_resumes(tmp_path):
+    serial_file = str(tmp_path / "serial.txt")
+    resumed_file = str(tmp_path / "resumed.txt")
+    generate_dataset_file(16, serial_file, 200)
+    # Stop after the checkpoint at seed 100, with a partial line written after it
+    generate_dataset_file(16, resumed_file, 100, checkpoint_every=50)
+    with open(resumed_file, "a") as f:
+        f.write(generate_dataset_line(16, 100)[:20])
+    generate_dataset_file(16, resumed_file, 200, checkpoint_every=50)
+    with open(serial_file, "rb") as f:
+        serial = f.read()
+    with open(resumed_file, "rb") as f:
+        assert f.read() == serial
+    with open(f"{resumed_file}.manifest.json", "r") as f:
+        assert json.load(f)["next_seed"] == 200
+
+
+def test_corrupted_dataset_file_is_regenerated(tmp_path):
+    serial_file = str(tmp_path / "serial.txt")
+    corrupted_file = str(tmp_path / "corrupted.txt")
+    generate_dataset_file(16, serial_file, 100)
+    generate_dataset_file(16, corrupted_file, 100)
+    with open(corrupted_file, "r+b") as f:
+        f.write(b"#")
+    generate_dataset_file(16, corrupted_file, 100)
+    with open(serial_file, "rb") as f:
+        serial = f.read()
+    with open(corrupted_file, "rb") as f:
+        assert f.read() == serial
@@ -0,0 +1,22 @@
+import os
+
+import pytest
+import torch
+
+from graphcot.benchmark import get_training_config
+from graphcot.fast_transformer import check_hooked_parity
+from graphcot.tree_generation.dataset import GraphTokenizer, generate_dataset_line
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "model.pt")
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH), reason="model.pt not found")
+def test_hooked_parity_on_model_checkpoint():
+    # The studied checkpoint, with the config it was trained with
+    tokenizer = GraphTokenizer(16)
+    lines = [generate_dataset_line(16, seed) for seed in range(512)]
+    tokens = torch.from_numpy(tokenizer.tokenize_batch(lines))[:, :-1]
+    results = check_hooked_parity(get_training_config(16, "cpu"), MODEL_PATH, tokens)
+    assert results["max_abs_diff"] < 1e-3
+    assert results["argmax_agreement"] == 1.0
+    assert results["round_trip_max_abs_diff"] == 0
@@ -2,15 +2,27 @@ import argparse
 
 from transformer_lens import HookedTransformer, HookedTransformerConfig
 
-from src.tree_generation import GraphDataset
-from src.utils import train, get_loaders
+from graphcot.fast_transformer import EnsembleTransformer, FastTransformer
+from graphcot.tree_generation import GraphDataset
+from graphcot.utils import train, get_loaders, get_device, setup_distributed, cleanup_distributed, \
+    main_process_first, configure_cpu_threads
 
 
 def main(args):
-   
-    # setup dataset 
-    dataset = GraphDataset(args.n_states, args.dataset_file_name, args.n_samples)
-    train_loader, test_loader = get_loaders(dataset, args.batch_size)
+
+    # join the process group when launched with torchrun --nproc_per_node=N training.py
+    setup_distributed()
+
+    # CUDA if available, otherwise CPU with tuned thread pools
+    device = get_device(args.device)
+    if device.type == "cpu":
+        configure_cpu_threads(args.n_threads)
+
+    # setup dataset, generated and cached by rank 0 only
+    with main_process_first():
+        dataset = GraphDataset(args.n_states, args.dataset_file_name, args.n_samples)
+        train_loader, test_loader = get_loaders(dataset, args.batch_size, dynamic_padding=args.dynamic_padding,
+                                                tensor_batches=args.tensor_batches)
 
     # setup model
     cfg = HookedTransformerConfig(
@@ -21,17 +33,28 @@ def main(args):
         d_mlp=args.d_mlp,
         d_head=args.d_head,
         d_vocab=len(dataset.idx2tokens),
-        device="cuda",
+        device=str(device),
         attention_dir="causal",
         act_fn="gelu",
     )
-    model = HookedTransformer(cfg)
+    # the fast model trains without hooks, its checkpoints load into HookedTransformer(cfg)
+    if args.n_members > 1:
+        # ensemble of fast models with seeds 0, ..., n_members - 1, checkpointed per member
+        model = EnsembleTransformer(cfg, seeds=range(args.n_members))
+    else:
+        model = FastTransformer(cfg) if args.fast_model else HookedTransformer(cfg)
+
+    # optional: resume from checkpoints, one per member for ensembles
+    checkpoint = args.checkpoint
+    if checkpoint is not None and args.n_members == 1:
+        checkpoint = checkpoint[0]
 
-    # optional: load model checkpoint
-    checkpoint = None
-    
     # start training loop
-    train(model, train_loader, test_loader, n_epochs=1000, learning_rate=3e-4) # checkpoint=checkpoint)
+    train(model, train_loader, test_loader, n_epochs=1000, learning_rate=3e-4, checkpoint=checkpoint,
+          use_wandb=not args.no_wandb, log_backend=args.log_backend, compile_step=args.compile,
+          precision=args.precision, eval_every=args.eval_every, eval_every_steps=args.eval_every_steps,
+          full_eval_every=args.full_eval_every, eval_subsample=args.eval_subsample, target_path_acc=args.target_path_acc)
+    cleanup_distributed()
 
 
 if __name__ == "__main__":
@@ -39,17 +62,41 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     # dataset configuration
-    parser.add_argument('--n_states', default=16)
+    parser.add_argument('--n_states', type=int, default=16)
     parser.add_argument('--dataset_file_name', default="dataset.txt")
-    parser.add_argument('--n_samples', default=150_000)
-    parser.add_argument('--batch_size', default=64)
+    parser.add_argument('--n_samples', type=int, default=150_000)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--dynamic_padding', action='store_true')
+    parser.add_argument('--tensor_batches', action='store_true')
 
     # model configuration
-    parser.add_argument('--n_layers', default=6)
-    parser.add_argument('--d_model', default=128)
-    parser.add_argument('--n_heads', default=1)
-    parser.add_argument('--d_mlp', default=512)
-    parser.add_argument('--d_head', default=128)
+    parser.add_argument('--n_layers', type=int, default=6)
+    parser.add_argument('--d_model', type=int, default=128)
+    parser.add_argument('--n_heads', type=int, default=1)
+    parser.add_argument('--d_mlp', type=int, default=512)
+    parser.add_argument('--d_head', type=int, default=128)
+    parser.add_argument('--fast_model', action='store_true')
+    parser.add_argument('--n_members', type=int, default=1)
+
+    # resume from a checkpoint_<epoch>.pt written by a previous run, one per member for ensembles
+    parser.add_argument('--checkpoint', default=None, nargs='+')
+
+    # logging configuration, metrics are always written locally to the run directory
+    parser.add_argument('--log_backend', default="jsonl", choices=["jsonl", "sqlite"])
+    parser.add_argument('--no_wandb', action='store_true')
+
+    # evaluation schedule, a stratified test subsample in between full test set evaluations
+    parser.add_argument('--eval_every', type=int, default=1, help="epochs between evaluations")
+    parser.add_argument('--eval_every_steps', type=int, default=None, help="also evaluate every this many steps")
+    parser.add_argument('--full_eval_every', type=int, default=50, help="epochs between full test set evaluations")
+    parser.add_argument('--eval_subsample', type=int, default=1024, help="test examples evaluated in between")
+    parser.add_argument('--target_path_acc', type=float, default=None, help="stop at this exact path accuracy (%%)")
+
+    # hardware configuration
+    parser.add_argument('--device', default=None, help="e.g. 'cuda' or 'cpu', defaults to cuda if available")
+    parser.add_argument('--n_threads', type=int, default=None, help="CPU threads per process, defaults to all cores")
+    parser.add_argument('--compile', action='store_true', help="compile the training step, not with --dynamic_padding")
+    parser.add_argument('--precision', default="fp32", choices=["fp32", "bf16"])
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file